@@ -92,6 +92,25 @@ def get_cli_arg_parser():
             "attempt will be made to get a new, valid staple (default: 7200)."
         )
     )
+    parser.add(
+        '--smoothing-window',
+        type=int,
+        default=0,
+        help=(
+            "Spread staple renewals that are due at the same time over this "
+            "amount of seconds before they are due, 0 disables smoothing "
+            "(default: 0)."
+        )
+    )
+    parser.add(
+        '--smoothing-rate',
+        type=float,
+        default=0,
+        help=(
+            "When smoothing, plan at most this many renewals per second per "
+            "OCSP responder, 0 for unlimited (default: 0)."
+        )
+    )
     parser.add(
         '-t',
         '--renewal-threads',
@@ -99,6 +118,78 @@ def get_cli_arg_parser():
         default=2,
         help="Amount of threads to run for renewing staples. (default=2)"
     )
+    parser.add(
+        '--renewal-engine',
+        type=str,
+        choices=['threads', 'asyncio'],
+        default='threads',
+        help=(
+            "Renew staples with a thread per request (``threads``) or with "
+            "many concurrent requests from an event loop (``asyncio``), the "
+            "latter uses ``--renewal-threads`` threads for validating "
+            "responses (default: threads)."
+        )
+    )
+    parser.add(
+        '--async-concurrency',
+        type=int,
+        default=100,
+        help=(
+            "Maximum amount of concurrent renewals with the asyncio renewal "
+            "engine (default: 100)."
+        )
+    )
+    parser.add(
+        '--parse-processes',
+        type=int,
+        default=0,
+        help=(
+            "Amount of worker processes that parse and validate certificates, "
+            "0 to parse in the parser thread (default: 0)."
+        )
+    )
+    parser.add(
+        '--max-responder-threads',
+        type=int,
+        default=0,
+        help=(
+            "Maximum amount of renewal threads that may be waiting for the "
+            "same OCSP server, so a slow OCSP server can't hold up renewals "
+            "for other OCSP servers, 0 for unlimited (default: 0)."
+        )
+    )
+    parser.add(
+        '--queue-size',
+        type=int,
+        default=1000,
+        help=(
+            "Maximum amount of tasks waiting in each of the parse and "
+            "proxy-add queues, threads wait for room when a queue is full so "
+            "memory use doesn't grow with the amount of certificates, 0 for "
+            "unlimited (default: 1000)."
+        )
+    )
+    parser.add(
+        '--state-dir',
+        type=str,
+        default=None,
+        help=(
+            "Directory to keep the state of parsed certificates and their "
+            "staples in, so unchanged certificates don't have to be parsed "
+            "and validated again after a restart (default: don't keep state)."
+        )
+    )
+    parser.add(
+        '--fsync-interval',
+        type=float,
+        default=0,
+        help=(
+            "Sync written staple files to disk before they replace the old "
+            "ones, and their directories in batches at most every this many "
+            "seconds, 0 to leave syncing to the operating system "
+            "(default: 0)."
+        )
+    )
     parser.add(
         '--verbosity',
         type=int,
@@ -143,6 +234,60 @@ def get_cli_arg_parser():
         help="Minimum time to wait between parsing cert dirs and "
         "certificates (default=60)."
     )
+    parser.add(
+        '--inotify',
+        action='store_true',
+        default=False,
+        help=(
+            "Use inotify (Linux only) to detect new, changed and deleted "
+            "certificate files as soon as they change, instead of scanning "
+            "the directories every ``--refresh-interval`` seconds."
+        )
+    )
+    parser.add(
+        '--full-rescan-interval',
+        type=int,
+        default=3600,
+        help=(
+            "When using inotify or ``--recursion-depth``, scan the "
+            "directories completely every this many seconds in case changes "
+            "were missed (default=3600)."
+        )
+    )
+    parser.add(
+        '--recursion-depth',
+        type=int,
+        default=0,
+        help=(
+            "Also search this many levels of subdirectories of the "
+            "directories for certificates. Subdirectories are only listed "
+            "again when files are added to, removed from or renamed in them, "
+            "files that are changed in place are found at the next full scan "
+            "(see ``--full-rescan-interval``), or right away when using "
+            "inotify. By default subdirectories are not searched."
+        )
+    )
+    parser.add(
+        '--scan-threads',
+        type=int,
+        default=0,
+        help=(
+            "Scan this many certificate directories at the same time, so a "
+            "slow directory, e.g. on a network mount, does not delay the "
+            "others. By default directories are scanned one by one."
+        )
+    )
+    parser.add(
+        '--scan-timeout',
+        type=int,
+        default=30,
+        help=(
+            "When scanning directories at the same time, skip a directory if "
+            "scanning it takes longer than this many seconds from when its "
+            "scan started, it is tried again at the first refresh after the "
+            "scan finished (default=30)."
+        )
+    )
     parser.add(
         '-l',
         '--logdir',
@@ -185,18 +330,67 @@ def get_cli_arg_parser():
             "``/etc/haproxy2/haproxy.sock``. I would then start ocspd as "
             "follows:"
             "``./ocspd /etc/haproxy1 /etc/haproxy2 -s /etc/haproxy1.sock "
-            "/etc/haproxy2.sock``"
+            "/etc/haproxy2.sock``. "
+            "If a directory is served by several HAProxy processes, pass "
+            "their sockets as a comma separated list, staples are sent to "
+            "all of them, e.g. ``/run/haproxy1.sock,/run/haproxy2.sock``. "
+            "Sockets for the ``--socket-directories`` follow the sockets for "
+            "the ``--directories``."
+        )
+    )
+    parser.add(
+        '--socket-directories',
+        type=str,
+        nargs='+',
+        help=(
+            "Directories that are not scanned, but contain certificate files "
+            "from ``--crt-lists`` or ``--manifests``, also in "
+            "subdirectories, that are served by the HAProxy sockets matching "
+            "them in ``--haproxy-sockets``, after the sockets of the "
+            "``--directories``."
         )
     )
     parser.add(
         '-d',
         '--directories',
-        required=True,
         type=str,
         nargs='+',
+        default=[],
         help=(
             "Directories containing the certificates used by HAProxy. "
             "Multiple directories may be specified separated by a space. "
+            "Required unless ``--crt-lists`` or ``--manifests`` are passed."
+        )
+    )
+    parser.add(
+        '--crt-lists',
+        type=str,
+        nargs='+',
+        help=(
+            "HAProxy crt-list files, the certificate files in them are used "
+            "regardless of their file extension. Relative paths are relative "
+            "to ``--crt-base`` if it is passed, otherwise to the directory of "
+            "the crt-list. A crt-list is only read again when it changes."
+        )
+    )
+    parser.add(
+        '--crt-base',
+        type=str,
+        help=(
+            "Directory that relative paths in crt-lists are relative to, use "
+            "the same directory as ``crt-base`` in your HAProxy "
+            "configuration (default: the directory of each crt-list)."
+        )
+    )
+    parser.add(
+        '--manifests',
+        type=str,
+        nargs='+',
+        help=(
+            "Files containing a certificate file path per line, the "
+            "certificate files in them are used regardless of their file "
+            "extension. Relative paths are relative to the directory of the "
+            "manifest. A manifest is only read again when it changes."
         )
     )
     parser.add(
@@ -234,7 +428,17 @@ def init():
     log_file_handles = []
     parser = get_cli_arg_parser()
     args = parser.parse_args()
+    if not (args.directories or args.crt_lists or args.manifests):
+        parser.error(
+            "the following arguments are required: -d/--directories, "
+            "--crt-lists or --manifests")
     args.directories = [os.path.abspath(d) for d in args.directories]
+    args.crt_lists = [os.path.abspath(f) for f in args.crt_lists or []]
+    args.manifests = [os.path.abspath(f) for f in args.manifests or []]
+    args.socket_directories = [
+        os.path.abspath(d) for d in args.socket_directories or []]
+    if args.crt_base:
+        args.crt_base = os.path.abspath(args.crt_base)
     verbose = args.verbose or args.verbosity
     log_level = max(min(50 - verbose * 10, 50), 10)
     logging.basicConfig()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+This module defines an alternative for the
+:class:`ocspd.core.ocsprenewer.OCSPRenewerThread` that runs an :mod:`asyncio`
+event loop. Instead of blocking a thread per OCSP request, a single thread
+sends many OCSP requests at the same time. Checking and validating the
+responses is CPU-bound, so that is done by a small pool of executor threads
+to keep the event loop responsive, as is the blocking work after a renewal.
+
+It takes renew task contexts from the scheduler just like the
+:class:`ocspd.core.ocsprenewer.OCSPRenewerThread`, it then requests, validates
+and writes the staple, schedules the next renewal and creates a task for the
+:class:`ocspd.core.oscpadder.OCSPAdder`.
+"""
+
+import asyncio
+import functools
+import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from ocspd.core.certmodel import OCSP_REQUEST_TIMEOUT
+from ocspd.core.excepthandler import ocsp_except_handle
+from ocspd.core.ocsprenewer import OCSPRenewerThread
+from ocspd.util.asynchttp import AsyncHTTPClient
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncOCSPRenewerThread(OCSPRenewerThread):
+    """
+    This object requests OCSP responses for many certificates at the same
+    time from one event loop. It has the same contract as the
+    :class:`ocspd.core.ocsprenewer.OCSPRenewerThread`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialise the thread's arguments and its parent
+        :class:`ocspd.core.ocsprenewer.OCSPRenewerThread`.
+
+        :kwarg int concurrency: Maximum amount of renewals in progress at the
+            same time (default=100).
+        :kwarg int validation_threads: Amount of threads that check and
+            validate responses (default=2).
+        """
+        self.concurrency = kwargs.pop('concurrency', 100)
+        self.validation_threads = kwargs.pop('validation_threads', 2)
+        super(AsyncOCSPRenewerThread, self).__init__(*args, **kwargs)
+
+    def run(self):
+        """
+        Start the renewer thread, and run the event loop until the thread is
+        stopped.
+        """
+        LOG.info(
+            "Started an asyncio renewer thread, with up to %d concurrent "
+            "renewals.", self.concurrency)
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(self.validation_threads)
+        try:
+            loop.run_until_complete(self._run(loop, executor))
+        finally:
+            executor.shutdown()
+            loop.close()
+        LOG.debug("Goodbye cruel world..")
+
+    async def _run(self, loop, executor):
+        """
+        Take renew tasks from the scheduler and start a renewal for each of
+        them, as long as less than :attr:`concurrency` renewals are running.
+
+        :param asyncio.AbstractEventLoop loop: The thread's event loop.
+        :param concurrent.futures.Executor executor: Executor for validation.
+        """
+        client = AsyncHTTPClient()
+        slots = asyncio.Semaphore(self.concurrency)
+        running = set()
+        get_task = functools.partial(
+            self.scheduler.get_task, "renew", timeout=0.25)
+        while not self.stop:
+            await slots.acquire()
+            try:
+                # Wait for a task without blocking the event loop.
+                context = await loop.run_in_executor(None, get_task)
+            except queue.Empty:
+                slots.release()
+                continue
+            task = loop.create_task(
+                self._renew(context, client, loop, executor, slots))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        if running:
+            await asyncio.wait(running)
+        client.close()
+
+    async def _renew(self, context, client, loop, executor, slots):
+        """
+        Renew the staple of the model in a renew task context.
+
+        :param ocspd.core.taskcontext.OCSPTaskContext context: A renew task.
+        :param ocspd.util.asynchttp.AsyncHTTPClient client: HTTP client.
+        :param asyncio.AbstractEventLoop loop: The thread's event loop.
+        :param concurrent.futures.Executor executor: Executor for validation.
+        :param asyncio.Semaphore slots: Semaphore to release when done.
+        """
+        # pylint: disable=too-many-arguments
+        try:
+            with ocsp_except_handle(context):
+                model = context.model
+                LOG.info("Renewing OCSP staple for \"%s\"..", model)
+                url, data, headers = model.prepare_ocsp_request()
+                LOG.info("Trying to get OCSP staple from url \"%s\"..", url)
+                response = await client.post(
+                    url,
+                    data=data,
+                    headers=headers,
+                    timeout=OCSP_REQUEST_TIMEOUT
+                )
+                # Raise HTTP exception if any occurred
+                response.raise_for_status()
+                changed = await loop.run_in_executor(
+                    executor,
+                    model.process_ocsp_response,
+                    response.content,
+                    url
+                )
+                # Scheduling tasks may wait for room in a queue, and saving
+                # state and writing staples of aliases does I/O, so keep that
+                # off the event loop.
+                await loop.run_in_executor(
+                    executor, self.renewed, model, changed)
+            self.scheduler.task_done("renew", context)
+        finally:
+            slots.release()
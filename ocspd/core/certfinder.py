@@ -9,32 +9,71 @@ them. It then keeps track of the following:
   certificate. The file modification time is recorded so file changes can be
   detected.
 
-- If a cert is found a second time, the modification time is compared to the
-  recorded modification time. If it differs, if it differs, the file is added
-  to the scheduler for parsing again, any scheduled actions for the old file
-  are cancelled.
+- If a cert is found a second time, the size, inode and modification time are
+  compared to the recorded ones. If they differ, the digest of the file's
+  content is compared to the recorded digest. If that differs too, the file is
+  added to the scheduler for parsing again, any scheduled actions for the old
+  file are cancelled. Files that were only touched keep their model and
+  scheduled actions.
 
 - When certificates are deleted from the directories, the entries are removed
   from the cache in :attr:`ocspd.core.daemon.run.models`. Any scheduled actions
   for deleted files are cancelled.
 
+Directories can be scanned concurrently by a few threads, each directory gets a
+time budget from when its scan starts. A directory that takes longer, e.g.
+because it is on a stalled network mount, is skipped until its scan finishes,
+so it doesn't hold up the other directories. Its files are not considered
+deleted.
+
+Directories can optionally be searched recursively, up to a maximum depth.
+The modification time of every directory is recorded, only directories whose
+modification time changed, i.e. files were added, removed or renamed, are
+listed again. Since changing a file in place does not change the modification
+time of its directory, all directories are listed completely at a long
+interval.
+
+Instead of, or besides searching directories, the certificate files can be
+read from HAProxy crt-list files or from manifest files that list one
+certificate file per line. Listed files are used regardless of their file
+extension. A list is only read again when it changed.
+
+On Linux, the finder can also be notified of changes in the directories by
+inotify instead of scanning them at regular intervals. Changed files are then
+handled within milliseconds, a full scan is still done at a long interval as a
+safety net.
+
 The cache of parsed files is volatile so every time the process is killed
-files need to be indexed again (thus files are considered "new").
+files need to be indexed again (thus files are considered "new"), unless a
+:class:`ocspd.core.statestore.StateStore` is used, in which case the parser
+restores the models of files that didn't change.
 """
 
 import threading
 import time
+import datetime
 import logging
-import re
 import os
+import stat as stat_module
+import queue
 import ocspd
 from ocspd.core.excepthandler import ocsp_except_handle
 from ocspd.core.taskcontext import OCSPTaskContext
-from ocspd.core.certmodel import CertModel
-from ocspd.util.cache import cache
+from ocspd.core.certmodel import CertModel, stat_signature, file_digest
+from ocspd.util.ignore import IgnoreMatcher
+from ocspd.util import inotify
 
 LOG = logging.getLogger(__name__)
 
+#: The inotify events the finder reacts to.
+INOTIFY_MASK = (
+    inotify.IN_CREATE |
+    inotify.IN_CLOSE_WRITE |
+    inotify.IN_MOVED_TO |
+    inotify.IN_MOVED_FROM |
+    inotify.IN_DELETE
+)
+
 
 class CertFinderThread(threading.Thread):
     """
@@ -62,6 +101,43 @@ class CertFinderThread(threading.Thread):
             only once **(optional)**.
         :kwarg array file_extensions: An array containing the file extensions
             of file types to check for certificate content **(optional)**.
+        :kwarg list ignore: Glob patterns of files to ignore **(optional)**.
+        :kwarg bool inotify: React to inotify events instead of scanning the
+            directories every ``refresh_interval`` seconds, falls back to
+            scanning if inotify is not available **(optional)**.
+        :kwarg int full_rescan_interval: When using inotify or recursion,
+            the amount of seconds between full scans of the directories, as a
+            safety net for missed events or changes **(optional)**.
+        :kwarg int recursion_depth: How many levels of subdirectories to
+            search, 0 to search only the directories themselves
+            **(optional)**.
+        :kwarg list crt_lists: HAProxy crt-list files, the certificate files
+            in them are used as well **(optional)**.
+        :kwarg str crt_base: Directory that relative paths in the crt-lists
+            are relative to, like HAProxy's ``crt-base``, instead of the
+            directory of the crt-list **(optional)**.
+        :kwarg list manifests: Files that list a certificate file path per
+            line, the certificate files in them are used as well
+            **(optional)**.
+        :kwarg dict cert_ids: The dict the
+            :class:`ocspd.core.certparser.CertParserThread` maintains the
+            models that renew staples in, by certificate **(optional)**.
+        :kwarg threading.Lock cert_ids_lock: Lock shared with the parser that
+            guards ``cert_ids`` and the aliases of models **(optional)**.
+        :kwarg ocspd.core.statestore.StateStore state_store: Store that keeps
+            the state of files, state of changed and deleted files is removed
+            from it, and after the first full scan the state of files that
+            no longer exist **(optional)**.
+        :kwarg int scan_threads: Amount of threads that scan directories
+            concurrently, 0 to scan them one by one in this thread
+            **(optional)**.
+        :kwarg int scan_timeout: Amount of seconds a concurrent scan of a
+            directory may take from when it starts, before it is skipped
+            **(optional)**.
+        :kwarg int minimum_validity: The amount of seconds before a staple
+            expires that it is renewed, used to schedule the renewal of a
+            model that takes over renewing a staple, without it the staple is
+            renewed ASAP **(optional)**.
         """
         self.stop = False
         self.models = kwargs.pop('models', None)
@@ -75,6 +151,33 @@ class CertFinderThread(threading.Thread):
         )
         self.last_refresh = None
         self.ignore = kwargs.pop('ignore', [])
+        self.ignore_matcher = IgnoreMatcher(self.ignore)
+        self.inotify = kwargs.pop('inotify', False)
+        self.full_rescan_interval = kwargs.pop('full_rescan_interval', 3600)
+        self.last_full_refresh = None
+        self.recursion_depth = kwargs.pop('recursion_depth', 0)
+        #: Modification time and subdirectories by directory, when recursing.
+        self._directories = {}
+        self.crt_lists = kwargs.pop('crt_lists', [])
+        self.crt_base = kwargs.pop('crt_base', None)
+        self.manifests = kwargs.pop('manifests', [])
+        #: Status signature and listed files by crt-list or manifest file.
+        self._lists = {}
+        #: The files that are currently listed in crt-lists and manifests.
+        self._listed = set()
+        #: Whether the directories to watch with inotify may have changed.
+        self._watch_changed = True
+        self.cert_ids = kwargs.pop('cert_ids', {})
+        self.cert_ids_lock = kwargs.pop('cert_ids_lock', threading.Lock())
+        self.state_store = kwargs.pop('state_store', None)
+        #: Whether the state of files that no longer exist was removed from
+        #: the state store.
+        self._state_pruned = False
+        self.scan_threads = kwargs.pop('scan_threads', 0)
+        self.scan_timeout = kwargs.pop('scan_timeout', 30)
+        self.minimum_validity = kwargs.pop('minimum_validity', None)
+        #: Threads of running or finished concurrent scans by directory.
+        self._scans = {}
 
         assert self.models is not None, \
             "You need to pass a dict to hold the certificate model cache."
@@ -94,6 +197,28 @@ class CertFinderThread(threading.Thread):
 
         LOG.info("Scanning directories: %s", ", ".join(self.directories))
 
+        self._run()
+        LOG.debug("Goodbye cruel world..")
+
+    def _run(self):
+        """
+        Refresh the cache with inotify if requested and available, otherwise
+        every :attr:`refresh_interval` seconds.
+        """
+        if self.inotify and self.refresh_interval is not None:
+            try:
+                watcher = inotify.Inotify()
+            except OSError as exc:
+                LOG.warning(
+                    "Can't use inotify, scanning directories instead: %s",
+                    exc)
+            else:
+                try:
+                    self._run_inotify(watcher)
+                finally:
+                    watcher.close()
+                return
+
         while not self.stop:
             # Catch any exceptions within this context to protect the thread.
             with ocsp_except_handle():
@@ -129,171 +254,688 @@ class CertFinderThread(threading.Thread):
                             break
                         time.sleep(1)
                         sleep_time = sleep_time - 1
-        LOG.debug("Goodbye cruel world..")
 
-    def refresh(self):
+    def _run_inotify(self, watcher):
+        """
+        Watch the directories with inotify and check files as soon as events
+        arrive for them. Events that arrive shortly after each other are
+        coalesced so a file that is written in several steps is only checked
+        once. The directories are scanned completely at the start and every
+        :attr:`full_rescan_interval` seconds.
+
+        :param ocspd.util.inotify.Inotify watcher: An inotify instance.
+        """
+        LOG.info("Watching directories for changes with inotify.")
+        with ocsp_except_handle():
+            self.refresh()
+        while not self.stop:
+            self._watch_directories(watcher)
+            with ocsp_except_handle():
+                events = watcher.read_events(timeout=1)
+                if events:
+                    # Coalesce bursts of events
+                    deadline = time.time() + 1
+                    more = events
+                    while more and time.time() < deadline:
+                        more = watcher.read_events(timeout=0.1)
+                        events.extend(more)
+                    self._handle_events(events)
+                since_last = time.time() - self.last_full_refresh
+                if since_last > self.full_rescan_interval:
+                    self.refresh(full=True)
+
+    def _watch_directories(self, watcher):
+        """
+        Add inotify watches for directories that are not watched yet, i.e.
+        the directories to search and, when recursing, their subdirectories.
+
+        :param ocspd.util.inotify.Inotify watcher: An inotify instance.
+        """
+        if not self._watch_changed:
+            return
+        self._watch_changed = False
+        watched = watcher.watched
+        paths = set(self.directories) | set(self._directories)
+        for filename in list(self._lists) + list(self._listed):
+            paths.add(os.path.dirname(filename))
+        for path in paths:
+            if path in watched:
+                continue
+            try:
+                watcher.add_watch(path, INOTIFY_MASK)
+            except OSError as exc:
+                LOG.critical("Can't watch directory: %s, reason: %s.",
+                             path, exc)
+                # Try again next time.
+                self._watch_changed = True
+            else:
+                watched.add(path)
+
+    def _handle_events(self, events):
+        """
+        Check every file that inotify events arrived for once.
+
+        :param list events: ``(path, mask)`` tuples.
+        """
+        paths = set()
+        for path, mask in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                LOG.warning("Missed inotify events, doing a full scan.")
+                self.refresh(full=True)
+                return
+            if mask & inotify.IN_IGNORED:
+                # A watched directory was removed, watch it again if it is
+                # created again.
+                self._watch_changed = True
+                continue
+            if mask & inotify.IN_ISDIR:
+                if self.recursion_depth:
+                    LOG.debug("Directory %s changed, refreshing.", path)
+                    self.refresh()
+                    return
+            elif path in self._lists:
+                LOG.debug("List %s changed, refreshing.", path)
+                self.refresh()
+                return
+            elif path is not None and (
+                    not mask & inotify.IN_CREATE or self._is_linked(path)):
+                # Files are checked when they are written, not when they are
+                # still empty, links are never written so they are checked
+                # when they are created.
+                paths.add(path)
+        LOG.debug("Received inotify events for %d files.", len(paths))
+        for filename in sorted(paths):
+            self._check_file(filename)
+
+    @staticmethod
+    def _is_linked(path):
+        """
+        Check whether a file that was just created already has its content,
+        i.e. it is a symbolic link, a hard link to an existing file or it is
+        not empty.
+
+        :param str path: Path of the file.
+        :return bool: True if the file should be checked now.
+        """
+        try:
+            stat = os.lstat(path)
+        except (IOError, OSError):
+            return False
+        return stat_module.S_ISLNK(stat.st_mode) or stat.st_nlink > 1 or \
+            stat.st_size > 0
+
+    def _check_file(self, filename):
+        """
+        Check whether a single file was added, changed or deleted, and handle
+        it accordingly.
+
+        :param str filename: Path of the file.
         """
-        Wraps up the internal :meth:`CertFinder._update_cached_certs()` and
-        :meth:`CertFinder._find_new_certs()` functions.
+        model = self.models.get(filename)
+        try:
+            stat = os.stat(filename)
+        except (IOError, OSError):
+            if model is not None:
+                self._deleted_model(filename)
+            return
+        if model is None:
+            if self._is_candidate(filename):
+                self._new_model(filename, stat)
+        elif self._is_changed(model, stat):
+            self._changed_model(filename, stat)
+
+    def _is_candidate(self, filename):
+        """
+        Check whether a file should be parsed, i.e. it is listed or it is in
+        one of the directories and has one of the file extensions, and it is
+        not on the ignore list.
+
+        :param str filename: Path of the file.
+        :return bool: True if the file should be parsed.
+        """
+        if filename not in self._listed:
+            directory = os.path.dirname(filename)
+            if directory not in self.directories and \
+                    directory not in self._directories:
+                return False
+            ext = os.path.splitext(filename)[1].lstrip(".")
+            if ext not in self.file_extensions:
+                return False
+        if self.check_ignore(filename):
+            LOG.debug(
+                "Ignoring file %s, because it's on the ignore list.",
+                filename
+            )
+            return False
+        return True
+
+    def refresh(self, full=False):
+        """
+        Compare the contents of the directories to the model cache in
+        :attr:`ocspd.core.daemon.run.models` in a single pass over each
+        directory.
+
+        New files are added to the cache and scheduled for parsing. Files that
+        changed since they were last seen are scheduled to get the new
+        certificate data parsed. Deleted files are removed from the cache.
+        Any scheduled tasks for the models of changed and deleted files are
+        cancelled.
+
+        When recursing, only directories that changed since the last refresh
+        are listed, unless a full refresh is requested or the last full
+        refresh was more than :attr:`full_rescan_interval` seconds ago.
 
         ..  Note:: This method is automatically called by
             :meth:`CertFinder.run()`
+
+        :param bool full: List all directories, also when recursing.
         """
         self.last_refresh = time.time()
-        LOG.info("Updating current cache..")
-        self._update_cached_certs()
-        LOG.info("Adding new certificates to cache..")
-        self._find_new_certs()
-
-    def _find_new_certs(self):
+        if self.last_full_refresh is None or full or \
+                self.last_refresh - self.last_full_refresh > \
+                self.full_rescan_interval:
+            full = True
+            self.last_full_refresh = self.last_refresh
+            if self.recursion_depth:
+                LOG.info("Doing a full scan of the directories.")
+        seen = set()
+        if self.scan_threads:
+            scanned = self._scan_concurrently(seen, full)
+        else:
+            scanned = set()
+            for path in self.directories:
+                scanned.update(self._scan(path, seen, full))
+
+        listed = set()
+        if self.crt_lists or self.manifests:
+            listed = self._check_listed(seen)
+        unlisted = self._listed | listed
+        if listed != self._listed:
+            self._watch_changed = True
+        self._listed = listed
+
+        # Purge certs that no longer exist in the cert dirs or lists, files in
+        # directories that could not be read are left alone.
+        for filename in list(self.models):
+            if filename in seen:
+                continue
+            if os.path.dirname(filename) in scanned or filename in unlisted:
+                self._deleted_model(filename)
+
+        # Remove the state of files that were deleted while the daemon was not
+        # running, once all directories could be scanned completely.
+        if self.state_store is not None and not self._state_pruned and \
+                full and all(path in scanned for path in self.directories):
+            self._state_pruned = True
+            self.state_store.prune(set(self.models))
+
+    def _check_listed(self, seen):
         """
-        Locate new files, schedule them for parsing.
+        Compare the files that are listed in the crt-lists and manifests to
+        the model cache.
 
-        :raises ocspd.core.exceptions.CertFileAccessError: When the certificate
-            file can't be accessed.
+        :param set seen: Paths of listed files that exist are added to it.
+        :return set: The listed files.
+        """
+        listed = set()
+        for path in self.crt_lists:
+            listed.update(self._read_list(path, crt_list=True))
+        for path in self.manifests:
+            listed.update(self._read_list(path))
+        for filename in listed:
+            model = self.models.get(filename)
+            try:
+                stat = os.stat(filename)
+            except (IOError, OSError) as exc:
+                if model is None:
+                    LOG.error(
+                        "Can't access listed file %s, reason: %s.",
+                        filename, exc
+                    )
+                continue
+            if model is None:
+                if self.check_ignore(filename):
+                    continue
+                self._new_model(filename, stat)
+            elif self._is_changed(model, stat):
+                self._changed_model(filename, stat)
+            seen.add(filename)
+        return listed
+
+    def _read_list(self, path, crt_list=False):
         """
+        Get the certificate files that are listed in a crt-list or manifest.
+        The list is only read if it changed since it was last read. Relative
+        paths are relative to the directory of the list, or for crt-lists to
+        :attr:`crt_base` if it is set.
+
+        A manifest has a path on every line, a HAProxy crt-list has a path
+        followed by optional SSL settings and SNI filters. Empty lines and
+        lines that start with ``#`` are skipped.
+
+        :param str path: Path of the list.
+        :param bool crt_list: Whether the list is a HAProxy crt-list.
+        :return tuple: The paths of the listed files, the previously listed
+            files if the list can't be read.
+        """
+        previous = self._lists.get(path, (None, ()))
+        try:
+            signature = stat_signature(os.stat(path))
+            if signature == previous[0]:
+                return previous[1]
+            with open(path, 'r') as f_obj:
+                lines = f_obj.readlines()
+        except (IOError, OSError) as exc:
+            LOG.critical("Can't read list: %s, reason: %s.", path, exc)
+            return previous[1]
+        base = os.path.dirname(path)
+        if crt_list and self.crt_base:
+            base = self.crt_base
+        files = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if crt_list:
+                line = line.split()[0]
+            files.append(os.path.normpath(os.path.join(base, line)))
+        LOG.info("Read %d certificate files from %s.", len(files), path)
+        self._lists[path] = (signature, tuple(files))
+        self._watch_changed = True
+        return tuple(files)
+
+    def _scan_concurrently(self, seen, full):
+        """
+        Scan at most :attr:`scan_threads` directories at the same time, each
+        in its own thread. A scan that takes longer than :attr:`scan_timeout`
+        seconds from when it started continues in the background, but it no
+        longer counts as one of the :attr:`scan_threads`, so stalled
+        directories can't hold up the others. A directory is not scanned
+        again before its previous scan is finished.
+
+        :param set seen: Paths of known files that were found are added to it.
+        :param bool full: List all directories, also when recursing.
+        :return set: The directories that were listed completely.
+        """
+        pending = []
         for path in self.directories:
+            thread = self._scans.get(path)
+            if thread is not None and thread.is_alive():
+                LOG.warning(
+                    "Directory %s is still being scanned, skipping it.", path)
+                continue
+            pending.append(path)
+        finished = queue.Queue()
+        results = {}
+        # Start time of the scans that are running, by directory.
+        running = {}
+
+        def scan(path):
             try:
-                LOG.info("Scanning directory: %s", path)
-                for filename in os.listdir(path):
-                    ext = os.path.splitext(filename)[1].lstrip(".")
-                    if ext not in self.file_extensions:
-                        continue
-                    filename = os.path.join(path, filename)
-                    if filename in self.models:
-                        continue
-                    if self.check_ignore(filename):
-                        LOG.debug(
-                            "Ignoring file %s, because it's on the ignore "
-                            "list.",
-                            filename
-                        )
-                        continue
-                    model = CertModel(filename)
-                    # Remember the model so we can compare the file later to
-                    # see if it changed.
-                    self.models[filename] = model
-                    # Schedule the certificate for parsing.
-                    context = OCSPTaskContext(
-                        task_name="parse",
-                        model=model,
-                        sched_time=None
+                results[path] = self._scan(path, seen, full)
+            finally:
+                finished.put(path)
+
+        scanned = set()
+        while pending or running:
+            while pending and len(running) < self.scan_threads:
+                path = pending.pop(0)
+                thread = threading.Thread(
+                    target=scan, args=(path,), name="scan", daemon=True)
+                self._scans[path] = thread
+                running[path] = time.time()
+                thread.start()
+            timeout = min(running.values()) + self.scan_timeout - time.time()
+            try:
+                path = finished.get(timeout=max(0, timeout))
+            except queue.Empty:
+                pass
+            else:
+                if path in running:
+                    del running[path]
+                    scanned.update(results.get(path, ()))
+            now = time.time()
+            for path, start in list(running.items()):
+                if now - start >= self.scan_timeout:
+                    LOG.error(
+                        "Scanning directory %s takes longer than %d seconds, "
+                        "skipping it until the scan finishes.",
+                        path,
+                        self.scan_timeout
                     )
-                    self.scheduler.add_task(context)
+                    del running[path]
+        return scanned
+
+    def _scan(self, path, seen, full=True):
+        """
+        Scan a directory, and its subdirectories when recursing, and log how
+        long it took.
+
+        :param str path: The directory to scan.
+        :param set seen: Paths of known files that were found are added to it.
+        :param bool full: List all directories, also when recursing.
+        :return set: The directories that were listed completely, empty if
+            the directory could not be read.
+        """
+        start = time.time()
+        scanned = set()
+        try:
+            self._walk(path, 0, seen, scanned, full)
+        except (IOError, OSError) as exc:
+            # If the directory is unreadable this gets printed at every
+            # refresh until the directory is readable. We catch this here
+            # so any readable directory can still be scanned.
+            LOG.critical(
+                "Can't read directory: %s, reason: %s.",
+                path, exc
+            )
+            return set()
+        LOG.info(
+            "Scanned directory %s in %0.3f seconds, listed %d directories.",
+            path,
+            time.time() - start,
+            len(scanned)
+        )
+        return scanned
+
+    def _walk(self, path, depth, seen, scanned, full):
+        """
+        Scan a directory, and when recursing, its subdirectories up to
+        :attr:`recursion_depth` levels deep. Directories whose modification
+        time did not change since they were last listed are not listed again,
+        unless ``full`` is True.
+
+        :param str path: The directory to scan.
+        :param int depth: The depth of the directory.
+        :param set seen: Paths of known files that were found are added to it.
+        :param set scanned: Directories that were listed are added to it,
+            also directories that were removed.
+        :param bool full: List all directories.
+        :raises OSError: If the directory can't be read.
+        """
+        # pylint: disable=too-many-arguments
+        if not self.recursion_depth:
+            self._scan_directory(path, seen)
+            scanned.add(path)
+            return
+        # Get the modification time before listing the directory, so any
+        # changes while listing it are noticed next time.
+        mtime = os.stat(path).st_mtime_ns
+        state = self._directories.get(path)
+        if full or state is None or state[0] != mtime:
+            subdirs = self._scan_directory(
+                path, seen, recurse=depth < self.recursion_depth)
+            scanned.add(path)
+            if state is not None:
+                for removed in set(state[1]) - set(subdirs):
+                    scanned.update(self._forget_directory(removed))
+            if state is None or set(state[1]) != set(subdirs):
+                self._watch_changed = True
+            self._directories[path] = (mtime, subdirs)
+        else:
+            subdirs = state[1]
+        for subdir in subdirs:
+            try:
+                self._walk(subdir, depth + 1, seen, scanned, full)
             except (IOError, OSError) as exc:
-                # If the directory is unreadable this gets printed at every
-                # refresh until the directory is readable. We catch this here
-                # so any readable directory can still be scanned.
-                LOG.critical(
+                LOG.error(
                     "Can't read directory: %s, reason: %s.",
-                    path, exc
+                    subdir, exc
                 )
 
-    def _del_model(self, filename):
+    def _forget_directory(self, path):
         """
-        Delete model from :attr:`ocspd.core.daemon.run.models` in a thread-safe
-        manner, if another thread deleted it, we should ignore the KeyError
-        making this function omnipotent.
+        Forget about a removed directory and its subdirectories.
 
-        :param str filename: The filename of the model to forget about.
+        :param str path: The removed directory.
+        :return set: The removed directory and its known subdirectories.
+        """
+        prefix = os.path.join(path, "")
+        removed = set(
+            directory for directory in list(self._directories)
+            if directory == path or directory.startswith(prefix)
+        )
+        for directory in removed:
+            self._directories.pop(directory, None)
+        removed.add(path)
+        return removed
+
+    def _scan_directory(self, path, seen, recurse=False):
+        """
+        Compare the files in a directory to the model cache, using the status
+        information that is returned by :func:`os.scandir`.
+
+        :param str path: The directory to scan.
+        :param set seen: Paths of known files that were found are added to it.
+        :param bool recurse: Return the subdirectories.
+        :return tuple: The paths of the subdirectories if ``recurse`` is True.
+        :raises OSError: If the directory can't be read.
+        """
+        LOG.debug("Scanning directory: %s", path)
+        subdirs = []
+        with os.scandir(path) as entries:
+            entries = list(entries)
+        if recurse:
+            files = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except (IOError, OSError):
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(os.path.join(path, entry.name))
+                else:
+                    files.append(entry)
+            entries = files
+        new = [
+            entry.name for entry in entries
+            if os.path.join(path, entry.name) not in self.models and
+            os.path.splitext(entry.name)[1].lstrip(".") in
+            self.file_extensions
+        ]
+        ignored = self.ignore_matcher.ignored(path, new)
+        if ignored:
+            LOG.debug(
+                "Ignoring %d files in %s, because they are on the ignore "
+                "list.", len(ignored), path
+            )
+        for entry in entries:
+            filename = os.path.join(path, entry.name)
+            model = self.models.get(filename)
+            if model is None:
+                if entry.name in ignored or \
+                        os.path.splitext(entry.name)[1].lstrip(".") not in \
+                        self.file_extensions:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except (IOError, OSError):
+                    # Deleted while scanning
+                    continue
+                self._new_model(filename, stat)
+                seen.add(filename)
+                continue
+            try:
+                stat = entry.stat()
+            except (IOError, OSError):
+                continue
+            seen.add(filename)
+            if self._is_changed(model, stat):
+                self._changed_model(filename, stat)
+        return tuple(subdirs)
+
+    def _is_changed(self, model, stat):
         """
+        Check whether a file's content changed since its model was made. The
+        size, inode and modification time are compared first, only if those
+        differ the file's content is compared. If only the file's status
+        changed, e.g. because it was touched, the recorded status is updated,
+        also in the state store.
+
+        :param ocspd.core.certmodel.CertModel model: The file's model.
+        :param os.stat_result stat: Current status of the file.
+        :return bool: True if the content changed.
+        """
+        signature = stat_signature(stat)
+        if signature == model.stat_signature:
+            return False
+        if model.parse_pending:
+            # Not parsed yet, parsing will read the current content.
+            model.modtime = stat.st_mtime
+            model.stat_signature = signature
+            return False
+        if model.digest is None:
+            # Parsing failed or is in progress, parse the new content.
+            return True
         try:
-            del self.models[filename]
-        except KeyError:
-            pass
+            digest = file_digest(model.filename)
+        except (IOError, OSError):
+            # Let parsing handle the error.
+            return True
+        if digest != model.digest:
+            return True
+        LOG.debug(
+            "File %s was touched but its content is unchanged.",
+            model.filename
+        )
+        model.modtime = stat.st_mtime
+        model.stat_signature = signature
+        if self.state_store is not None:
+            self.state_store.update_status(model)
+        return False
 
-    def _update_cached_certs(self):
+    def _new_model(self, filename, stat=None):
         """
-        Loop through the list of files that were already found and check
-        whether they were deleted or changed.
+        Make a model for a new file and schedule it for parsing.
 
-        If a file was modified since it was last seen, the file is added to the
-        scheduler to get the new certificate data parsed.
+        :param str filename: Path of the new file.
+        :param os.stat_result stat: Status of the file if it is known.
+        :raises ocspd.core.exceptions.CertFileAccessError: When the certificate
+            file can't be accessed.
+        """
+        model = CertModel(filename, stat)
+        model.parse_pending = True
+        # Remember the model so we can compare the file later to
+        # see if it changed.
+        self.models[filename] = model
+        # Schedule the certificate for parsing.
+        context = OCSPTaskContext(
+            task_name="parse",
+            model=model,
+            sched_time=None
+        )
+        self._add_task(context)
 
-        Deleted files are removed from the model cache in
-        :attr:`ocspd.core.daemon.run.models`. Any scheduled tasks for the
-        model's task context are cancelled.
+    def _deleted_model(self, filename):
+        """
+        Forget about the model of a deleted file.
 
+        :param str filename: Path of the deleted file.
+        """
+        # Cancel any scheduled tasks for the model.
+        self.scheduler.cancel_by_subject(self.models[filename])
+        self._detach_model(self.models[filename])
+        self._forget_state(filename)
+        # Remove the model from cache
+        self._del_model(filename)
+        LOG.info(
+            "File %s was deleted, removing it from the cache.", filename)
+
+    def _changed_model(self, filename, stat=None):
+        """
+        Replace the model of a changed file and schedule it for parsing.
+
+        :param str filename: Path of the changed file.
+        :param os.stat_result stat: Status of the file if it is known.
         :raises ocspd.core.exceptions.CertFileAccessError: When the certificate
             file can't be accessed.
         """
-        deleted = []
-        changed = []
-        for filename, model in self.models.items():
-            if not os.path.exists(filename):
-                deleted.append(filename)
-            elif os.path.getmtime(filename) > model.modtime:
-                changed.append(filename)
-
-        # purge certs that no longer exist in the cert dirs
-        for filename in deleted:
-            # Cancel any scheduled tasks for the model.
-            self.scheduler.cancel_by_subject(self.models[filename])
-            # Remove the model from cache
-            self._del_model(filename)
-            LOG.info(
-                "File %s was deleted, removing it from the cache.", filename)
-
-        # re-add files that have changed
-        for filename in changed:
-            # Cancel any scheduled tasks for the model.
-            self.scheduler.cancel_by_subject(self.models[filename])
-            # Remove the model from cache.
-            self._del_model(filename)
-            # Make a new model.
-            LOG.info("File %s changed, parsing it again.", filename)
-            new_model = CertModel(filename)
-            context = OCSPTaskContext(
-                task_name="parse", model=new_model, sched_time=None)
-            self.scheduler.add_task(context)
-
-    @cache(10000)
-    def check_ignore(self, path):
+        # Cancel any scheduled tasks for the model.
+        self.scheduler.cancel_by_subject(self.models[filename])
+        self._detach_model(self.models[filename])
+        self._forget_state(filename)
+        # Remove the model from cache.
+        self._del_model(filename)
+        # Make a new model.
+        LOG.info("File %s changed, parsing it again.", filename)
+        self._new_model(filename, stat)
+
+    def _forget_state(self, filename):
         """
-        Check if a file path matches any pattern in the ignore list.
+        Remove the saved state of a changed or deleted file.
 
-        :param str path: Path to a file to match.
+        :param str filename: Path of the file.
         """
-        for pattern in self.ignore:
-            regex = self.compile_pattern(pattern)
-            if regex.match(path):
-                return True
-        return False
+        if self.state_store is not None:
+            self.state_store.forget(filename)
 
-    @staticmethod
-    @cache(100)
-    def compile_pattern(pattern):
+    def _detach_model(self, model):
         """
-        Compile a glob pattern and return a compiled regex object.
+        Stop sharing staples between a model that is about to be removed and
+        the models of other files with the same certificate. If the model
+        renewed the staples for the others, one of them takes over. It
+        already has a copy of the staple, so its renewal is scheduled
+        ``minimum_validity`` seconds before that staple expires.
 
-        :param str pattern: Glob pattern.
+        :param ocspd.core.certmodel.CertModel model: The model to detach.
         """
-        # Absolute or relative path
-        if not pattern.startswith(os.sep) or pattern.startswith("*"):
-            begin_regex = "^.*"  # relative
-        else:
-            begin_regex = "^{}".format(os.sep)  # absolute
+        with self.cert_ids_lock:
+            successor = model.detach()
+            if model.cert_id is None or \
+                    self.cert_ids.get(model.cert_id) is not model:
+                return
+            if successor is None:
+                del self.cert_ids[model.cert_id]
+                return
+            self.cert_ids[model.cert_id] = successor
+        LOG.info("File %s takes over renewing staples from %s.",
+                 successor, model)
+        sched_time = None
+        staple = successor.ocsp_staple
+        if self.minimum_validity is not None and staple is not None and \
+                staple.valid_until is not None:
+            sched_time = staple.valid_until - datetime.timedelta(
+                seconds=self.minimum_validity)
+            if sched_time <= datetime.datetime.now():
+                sched_time = None
+        context = OCSPTaskContext(
+            task_name="renew", model=successor, sched_time=sched_time)
+        self._add_task(context, smooth=True)
+
+    def _add_task(self, context, smooth=False):
+        """
+        Add a task to the scheduler, wait for room in its queue if the queue
+        is full, unless the thread is stopped.
 
-        if pattern.endswith(os.sep) or pattern.endswith("*"):
-            end_regex = ".*$"  # anything below this path matches
-        else:
-            end_regex = "$"  # only exactly this file name matches
-
-        pattern = pattern.lstrip("*{}".format(os.sep))
-        pattern = pattern.rstrip("*")
-
-        # Escape some characters
-        middle_regex = re.escape(pattern)
-        # Question marks replace any 1 character
-        middle_regex = middle_regex.replace("\?", ".")
-        # Double stars replace anything including "/" lazily
-        middle_regex = middle_regex.replace("\*\*", ".*?/?".format(os.sep))
-        # Single star replaces anthing but "/"
-        middle_regex = middle_regex.replace("\*", "[^{}]*".format(os.sep))
-
-        regex = "{}{}{}".format(
-            begin_regex,
-            middle_regex,
-            end_regex
-        )
-        return re.compile(regex, re.IGNORECASE)
+        :param ocspd.core.taskcontext.OCSPTaskContext context: The task.
+        :param bool smooth: Let the scheduler smooth the scheduled time.
+        """
+        while not self.stop:
+            try:
+                self.scheduler.add_task(context, smooth=smooth, timeout=1)
+                return
+            except queue.Full:
+                LOG.debug("The %s queue is full, waiting..", context.task_name)
+
+    def _del_model(self, filename):
+        """
+        Delete model from :attr:`ocspd.core.daemon.run.models` in a thread-safe
+        manner, if another thread deleted it, we should ignore the KeyError
+        making this function omnipotent.
+
+        :param str filename: The filename of the model to forget about.
+        """
+        try:
+            del self.models[filename]
+        except KeyError:
+            pass
+
+    def check_ignore(self, path):
+        """
+        Check if a file path matches any pattern in the ignore list.
+
+        :param str path: Path to a file to match.
+        """
+        return self.ignore_matcher.match(path)
@@ -19,8 +19,12 @@ The following logic is contained within the context class:
 """
 import os
 import logging
+import stat as stat_module
 import binascii
 import datetime
+import hashlib
+import threading
+import weakref
 import requests
 import certvalidator
 import ocspbuilder
@@ -31,44 +35,149 @@ from ocspd.core.exceptions import OCSPBadResponse
 from ocspd.core.exceptions import RenewalRequirementMissing
 from ocspd.core.exceptions import CertParsingError
 from ocspd.core.exceptions import CertValidationError
+from ocspd.core.truststore import TRUST_STORE
 from ocspd.util.ocsp import OCSPResponseParser
 from ocspd.util.functions import pretty_base64
-from ocspd.util.cache import cache
+from ocspd.util.cache import LRUCache
+from ocspd.util.fsync import SyncBatch
 from future.standard_library import hooks
 with hooks():
     from urllib.parse import urlparse
 
 LOG = logging.getLogger(__name__)
 
+#: Connect and read timeouts in seconds for requests to OCSP servers.
+OCSP_REQUEST_TIMEOUT = (10, 5)
+
+#: Certificate chains that were validated without OCSP staple, by end entity
+#: fingerprint, intermediates fingerprint and trust store generation.
+CHAIN_CACHE = LRUCache(max_size=50000, ttl=3600)
+
+#: Written staple files that still need to be synced to disk, the daemon sets
+#: the interval and flushes it.
+STAPLE_SYNC = SyncBatch()
+
+#: Parsed CA certificates by fingerprint, shared by all models that use them.
+#: Certificates disappear from it when no model references them anymore.
+_INTERMEDIATES = weakref.WeakValueDictionary()
+_INTERMEDIATES_LOCK = threading.Lock()
+
+
+def intern_certificate(der_bytes):
+    """
+    Get the shared parsed certificate for DER encoded certificate data, so
+    identical CA certificates are parsed and kept in memory only once.
+
+    :param bytes der_bytes: DER encoded certificate.
+    :return asn1crypto.x509.Certificate: The shared parsed certificate.
+    """
+    fingerprint = hashlib.sha256(der_bytes).digest()
+    with _INTERMEDIATES_LOCK:
+        crt = _INTERMEDIATES.get(fingerprint)
+        if crt is None:
+            crt = asn1crypto.x509.Certificate.load(der_bytes)
+            # Parse it completely now, so threads that share it don't parse
+            # parts of it at the same time.
+            _ = crt.native, crt.ca
+            _INTERMEDIATES[fingerprint] = crt
+        return crt
+
+
+def parse_crt_file(filename):
+    """
+    Parse and validate a certificate file. This is meant to run in a worker
+    process of a :class:`multiprocessing.Pool`, so parsing and validating
+    many certificates can use all CPU cores.
+
+    :param str filename: The certificate file to parse.
+    :return dict: The result of :meth:`CertModel.parse_result`.
+    :raises ocspd.core.exceptions.CertFileAccessError: When the certificate
+        file can't be accessed.
+    :raises CertParsingError: If the certificate file can't be read, it
+        contains errors or parts of the chain are missing.
+    :raises CertValidationError: If there is any problem with the certificate
+        chain.
+    """
+    model = CertModel(filename)
+    model.parse_crt_file()
+    return model.parse_result()
+
+
+def stat_signature(stat):
+    """
+    Get the properties of a file's status that change when the file is
+    changed or replaced.
+
+    :param os.stat_result stat: Result of :func:`os.stat` or
+        :meth:`os.DirEntry.stat`.
+    :return tuple: Size, inode and modification time in nanoseconds.
+    """
+    return (stat.st_size, stat.st_ino, stat.st_mtime_ns)
+
+
+def file_digest(filename):
+    """
+    Get the SHA-256 digest of a file's content.
+
+    :param str filename: Path of the file.
+    :return bytes: The digest.
+    :raises OSError: If the file can't be read.
+    """
+    with open(filename, 'rb') as f_obj:
+        return hashlib.sha256(f_obj.read()).digest()
+
 
 class CertModel(object):
     """
     Model for certificate files.
     """
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, filename):
+    def __init__(self, filename, stat=None):
         """
-        Initialise the CertModel model object, and read the certificate data
-        from the passed filename.
+        Initialise the CertModel model object, the certificate data is read
+        from the passed filename when it is parsed.
 
+        :param str filename: Path of the certificate file.
+        :param os.stat_result stat: Status of the file if it is already known,
+            saves a system call.
         :raises ocspd.core.exceptions.CertFileAccessError: When the certificate
             file can't be accessed.
         """
         self.filename = filename
-        self.modtime = os.path.getmtime(filename)
+        if stat is None:
+            try:
+                stat = os.stat(filename)
+            except (IOError, OSError) as exc:
+                raise CertFileAccessError(
+                    "Can't access file %s, reason: %s", filename, exc)
+        self.modtime = stat.st_mtime
+        #: Result of :func:`stat_signature` for the file when it was found.
+        self.stat_signature = stat_signature(stat)
         self.end_entity = None
         self.intermediates = []
         self.ocsp_staple = None
         self.ocsp_urls = []
         self.chain = []
+        #: SHA-256 fingerprints of the certificates in the validated chain.
+        self.chain_fingerprints = []
+        #: Issuer public key hash and serial number, once parsed.
+        self.cert_id = None
+        #: The model that renews the staple for the same certificate found in
+        #: another file, if any.
+        self.primary = None
+        #: Models of other files with the same certificate, that get a copy
+        #: of the staples of this model.
+        self.aliases = []
         self.url_index = 0
         self.crt_data = None
-        try:
-            with open(filename, 'rb') as f_obj:
-                self.crt_data = f_obj.read()
-        except (IOError, OSError) as exc:
-            raise CertFileAccessError(
-                "Can't access file %s, reason: %s", filename, exc)
+        self._ocsp_request = None
+        #: SHA-256 digest of the file's content when it was parsed.
+        self.digest = None
+        #: True while the model waits to be parsed, the file is read when
+        #: parsing starts.
+        self.parse_pending = False
+        #: SHA-256 digest of the staple file as it was last read or written.
+        self.staple_digest = None
 
     def parse_crt_file(self):
         """
@@ -79,8 +188,168 @@ class CertModel(object):
         intermediates*), and validates the certificate chain.
         """
         LOG.info("Parsing file \"%s\"..", self.filename)
-        self._read_full_chain()
+        self._read_crt_file()
+        try:
+            self._read_full_chain()
+        finally:
+            # The raw file data is not needed anymore once it is parsed.
+            self.crt_data = None
         self.chain = self._validate_cert()
+        self.chain_fingerprints = [
+            hashlib.sha256(crt.dump()).hexdigest() for crt in self.chain
+        ]
+        self.cert_id = self._make_cert_id()
+
+    def _read_crt_file(self):
+        """
+        Read the certificate file into :attr:`crt_data`.
+
+        :raises ocspd.core.exceptions.CertFileAccessError: When the certificate
+            file can't be accessed.
+        """
+        try:
+            with open(self.filename, 'rb') as f_obj:
+                self.crt_data = f_obj.read()
+        except (IOError, OSError) as exc:
+            raise CertFileAccessError(
+                "Can't access file %s, reason: %s", self.filename, exc)
+        self.digest = hashlib.sha256(self.crt_data).digest()
+
+    def parse_result(self):
+        """
+        Get the result of :meth:`parse_crt_file` in a compact form that can
+        be pickled, so it can be sent from a worker process.
+
+        :return dict: The DER encoded ``end_entity``, ``intermediates`` and
+            validated ``chain``, the ``ocsp_urls``, the ``chain_fingerprints``
+            and the ``digest`` of the file.
+        """
+        return {
+            'digest': self.digest,
+            'end_entity': self.end_entity.dump(),
+            'intermediates': [crt.dump() for crt in self.intermediates],
+            'chain': [crt.dump() for crt in self.chain],
+            'ocsp_urls': list(self.ocsp_urls),
+            'chain_fingerprints': self.chain_fingerprints,
+        }
+
+    def apply_parse_result(self, result):
+        """
+        Use the result of a :meth:`parse_crt_file` call on another model,
+        typically in a worker process, instead of parsing the certificate
+        file in this process.
+
+        :param dict result: The result of :meth:`parse_result`.
+        """
+        self.crt_data = None
+        self.digest = result['digest']
+        self.end_entity = asn1crypto.x509.Certificate.load(
+            result['end_entity'])
+        self.intermediates = [
+            intern_certificate(der) for der in result['intermediates']
+        ]
+        self.chain = [
+            self.end_entity if der == result['end_entity']
+            else intern_certificate(der)
+            for der in result['chain']
+        ]
+        self.ocsp_urls = result['ocsp_urls']
+        self.chain_fingerprints = result['chain_fingerprints']
+        self.cert_id = self._make_cert_id()
+
+    def saved_state(self):
+        """
+        Get the state of a parsed model that is kept by the
+        :class:`ocspd.core.statestore.StateStore`.
+
+        :return dict: The ``parse_result``, the ``ocsp_request`` if it was
+            generated, and the ``staple_digest`` and ``staple_until`` time of
+            the current staple if there is one.
+        """
+        staple_digest = staple_until = None
+        if self.ocsp_staple is not None:
+            staple_digest = hashlib.sha256(self.ocsp_staple.data).digest()
+            staple_until = self.ocsp_staple.valid_until
+        return {
+            'parse_result': self.parse_result(),
+            'ocsp_request': self._ocsp_request,
+            'staple_digest': staple_digest,
+            'staple_until': staple_until,
+        }
+
+    def restore_state(self, state):
+        """
+        Restore a model from its saved state instead of parsing and
+        validating the certificate file. The staple file is used if it is
+        still the staple that was saved and it did not expire.
+
+        :param dict state: The state returned by
+            :meth:`ocspd.core.statestore.StateStore.restore`.
+        :return bool: True if the saved staple was restored.
+        """
+        self.apply_parse_result(state['parse_result'])
+        self._ocsp_request = state['ocsp_request']
+        if state['staple_digest'] is None or state['staple_until'] is None or \
+                state['staple_until'] <= datetime.datetime.now():
+            return False
+        try:
+            with open("{}.ocsp".format(self.filename), 'rb') as f_obj:
+                staple = f_obj.read()
+        except (IOError, OSError):
+            return False
+        if hashlib.sha256(staple).digest() != state['staple_digest']:
+            LOG.info("Staple of %s changed, not restoring it.", self.filename)
+            return False
+        self.ocsp_staple = OCSPResponseParser(staple)
+        self.staple_digest = state['staple_digest']
+        return True
+
+    def _make_cert_id(self):
+        """
+        Identify the certificate the way OCSP does, so the same certificate
+        in different files can be recognised.
+
+        :return tuple: SHA-1 hash of the issuer's public key and the serial
+            number of the certificate.
+        """
+        return (self.chain[-2].public_key.sha1, self.end_entity.serial_number)
+
+    def add_alias(self, model):
+        """
+        Let another model of the same certificate share the staples of this
+        model, instead of renewing them itself.
+
+        :param CertModel model: Model of another file with the same
+            certificate.
+        """
+        model.primary = self
+        self.aliases.append(model)
+        if self.ocsp_staple is not None:
+            model.ocsp_staple = self.ocsp_staple
+
+    def detach(self):
+        """
+        Stop sharing staples with other models, e.g. because the file was
+        deleted or changed. If this model has aliases, the first one takes
+        over and the others become its aliases.
+
+        :return CertModel: The model that took over, or None.
+        """
+        if self.primary is not None:
+            try:
+                self.primary.aliases.remove(self)
+            except ValueError:
+                pass
+            self.primary = None
+            return None
+        if not self.aliases:
+            return None
+        successor = self.aliases[0]
+        successor.primary = None
+        for alias in self.aliases[1:]:
+            successor.add_alias(alias)
+        self.aliases = []
+        return successor
 
     def recycle_staple(self, minimum_validity):
         """
@@ -112,6 +381,7 @@ class CertModel(object):
             LOG.error("Can't access %s, let's schedule a renewal.", ocsp_file)
             return False
 
+        self.staple_digest = hashlib.sha256(staple).digest()
         staple = OCSPResponseParser(staple)
         now = datetime.datetime.now()
         until = staple.valid_until
@@ -144,11 +414,15 @@ class CertModel(object):
         # schedule a regular renewal before expiry!
         return True
 
-    def renew_ocsp_staple(self):
+    def renew_ocsp_staple(self, session_pool=None):
         """
         Renew the OCSP staple, validate it and save it to the file path of the
         certificate file (``certificate.pem.ocsp``).
 
+        :param ocspd.util.sessionpool.SessionPool session_pool: Pool of HTTP
+            sessions to send the OCSP request with, so connections to the
+            OCSP server are re-used. If not passed a new connection is made.
+
         .. Note:: This method handles a lot of exceptions, some of then are
             non-fatal and might lead to retries. When they are fatal,
             one of the exceptions documented below is raised. Exceptions are
@@ -177,11 +451,36 @@ class CertModel(object):
             us too many times.
         :raises requests.exceptions.HTTPError: A HTTP error code was returned.
         :raises requests.ConnectionError: A Connection error occurred.
+        :return bool: False if the staple file already contained the new
+            staple, see :meth:`write_ocsp_staple`.
 
         .. TODO:: Send merge request to ocspbuider, for setting the hostname in
             the headers while fetching OCSP records. If accepted the request
             library won't be needed anymore.
         """
+        url, data, headers = self.prepare_ocsp_request()
+        LOG.info("Trying to get OCSP staple from url \"%s\"..", url)
+        if session_pool is None:
+            session_pool = requests
+        request = session_pool.post(
+            url,
+            data=data,
+            headers=headers,
+            timeout=OCSP_REQUEST_TIMEOUT
+        )
+        # Raise HTTP exception if any occurred
+        request.raise_for_status()
+        return self.process_ocsp_response(request.content, url)
+
+    def prepare_ocsp_request(self):
+        """
+        Check the requirements for a renewal and gather what is needed to
+        send the OCSP request to the current OCSP URL.
+
+        :return tuple: The URL, the request data and the HTTP headers.
+        :raises RenewalRequirementMissing: A requirment for the renewal is
+            missing.
+        """
         if not self.end_entity:
             raise RenewalRequirementMissing(
                 "Certificate is missing in \"{}\", can't validate "
@@ -195,23 +494,29 @@ class CertModel(object):
 
         url = self.ocsp_urls[self.url_index]
         host = urlparse(url).hostname
-        LOG.info("Trying to get OCSP staple from url \"%s\"..", url)
-        request = requests.post(
-            url,
-            data=bytes(self.ocsp_request),
-            # Set 'Host' header because Let's Encrypt server might not
-            # react when it's absent
-            headers={
-                'Content-Type': 'application/ocsp-request',
-                'Accept': 'application/ocsp-response',
-                'Host': host
-            },
-            timeout=(10, 5)
-        )
-        # Raise HTTP exception if any occurred
-        request.raise_for_status()
+        # Set 'Host' header because Let's Encrypt server might not
+        # react when it's absent
+        headers = {
+            'Content-Type': 'application/ocsp-request',
+            'Accept': 'application/ocsp-response',
+            'Host': host
+        }
+        return url, bytes(self.ocsp_request), headers
+
+    def process_ocsp_response(self, ocsp_staple, url):
+        """
+        Check and validate a received OCSP response and save it to the file
+        path of the certificate file (``certificate.pem.ocsp``).
 
-        ocsp_staple = request.content
+        :param bytes ocsp_staple: The body of the OCSP server's response.
+        :param str url: The URL the response was received from.
+        :raises OCSPBadResponse: Response is empty, invalid or the status is
+            not "good".
+        :raises CertValidationError: The certificate chain can't be validated
+            with the staple.
+        :return bool: False if the staple file already contained the new
+            staple, see :meth:`write_ocsp_staple`.
+        """
         self.ocsp_staple = self._check_ocsp_response(ocsp_staple, url)
 
         # If we got this far it means we have a staple in self.ocsp_staple
@@ -225,10 +530,53 @@ class CertModel(object):
         self._validate_cert(self.ocsp_staple)
         # No exception was raised, so we can assume the staple is ok and write
         # it to disk.
+        LOG.info("Succesfully validated staple for \"%s\"", self.filename)
+        return self.write_ocsp_staple(ocsp_staple)
+
+    def write_ocsp_staple(self, ocsp_staple):
+        """
+        Write an OCSP staple to the file path of the certificate file
+        (``certificate.pem.ocsp``), unless the file already contains the same
+        staple.
+
+        The staple is written to a temporary file that replaces the staple
+        file, so a proxy reading the staple file never sees a partial staple.
+        When syncing is enabled, the temporary file is synced to disk before
+        it is renamed, and the directory with the next batch of
+        :data:`STAPLE_SYNC`.
+
+        :param bytes ocsp_staple: The binary OCSP staple.
+        :raises OSError: If the file can't be written.
+        :return bool: True if the staple was written, False if the staple file
+            already contained it.
+        """
         ocsp_filename = "{}.ocsp".format(self.filename)
-        LOG.info("Succesfully validated writing to file \"%s\"", ocsp_filename)
-        with open(ocsp_filename, 'wb') as f_obj:
-            f_obj.write(ocsp_staple)
+        digest = hashlib.sha256(ocsp_staple).digest()
+        if digest == self.staple_digest and os.path.exists(ocsp_filename):
+            LOG.info("Staple in file \"%s\" is unchanged.", ocsp_filename)
+            return False
+        LOG.info("Writing staple to file \"%s\"", ocsp_filename)
+        tmp_filename = "{}.{}.tmp".format(
+            ocsp_filename, threading.current_thread().ident)
+        try:
+            with open(tmp_filename, 'wb') as f_obj:
+                f_obj.write(ocsp_staple)
+                STAPLE_SYNC.sync_file(f_obj)
+            try:
+                # Keep permissions that were set on the existing staple file.
+                os.chmod(tmp_filename, stat_module.S_IMODE(
+                    os.stat(ocsp_filename).st_mode))
+            except (IOError, OSError):
+                pass
+            os.replace(tmp_filename, ocsp_filename)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_filename)
+            except (IOError, OSError):
+                pass
+            raise
+        self.staple_digest = digest
+        STAPLE_SYNC.add(ocsp_filename)
         return True
 
     def _check_ocsp_response(self, ocsp_staple, url):
@@ -293,7 +641,8 @@ class CertModel(object):
                     crt = asn1crypto.x509.Certificate.load(der_bytes)
                     if getattr(crt, 'ca'):
                         LOG.info("Found part of the chain..")
-                        self.intermediates.append(crt)
+                        self.intermediates.append(
+                            intern_certificate(der_bytes))
                     else:
                         LOG.info("Found the end entity..")
                         self.end_entity = crt
@@ -333,17 +682,29 @@ class CertModel(object):
             certiticates in the chain is. With the exception of the root, which
             is usually not kept with the intermediates and the certificate
             because ever client has its own copy of it.
+
+        .. Note:: Chains validated without OCSP staple are cached in
+            :data:`CHAIN_CACHE`, so validating an unchanged certificate again
+            skips building and validating the path.
         """
+        cache_key = None
+        if ocsp_staple is None:
+            cache_key = self._chain_cache_key()
+            chain = CHAIN_CACHE.get(cache_key)
+            if chain is not None:
+                LOG.info(
+                    "Certificate chain for \"%s\" was validated before.",
+                    self.filename
+                )
+                return chain
         try:
             if ocsp_staple is None:
                 LOG.info("Validating without OCSP staple.")
-                context = certvalidator.ValidationContext()
+                context = TRUST_STORE.validation_context()
             else:
                 LOG.info("Validating with OCSP staple.")
-                context = certvalidator.ValidationContext(
-                    ocsps=[ocsp_staple.data],
-                    allow_fetching=False
-                )
+                context = TRUST_STORE.validation_context(
+                    ocsps=[ocsp_staple.data])
             validator = certvalidator.CertificateValidator(
                 self.end_entity,
                 self.intermediates,
@@ -355,6 +716,8 @@ class CertModel(object):
                 extended_optional=True
             )
             LOG.info("Certificate chain for \"%s\" validated.", self.filename)
+            if cache_key is not None:
+                CHAIN_CACHE.set(cache_key, chain)
             return chain
         except certvalidator.errors.RevokedError:
             raise CertValidationError(
@@ -374,16 +737,52 @@ class CertModel(object):
                 "try to parse it again.".format(self.filename)
             )
 
+    def _chain_cache_key(self):
+        """
+        Make a key for :data:`CHAIN_CACHE` from the fingerprints of the end
+        entity and the intermediates, and the current trust roots.
+
+        :return tuple: End entity fingerprint, intermediates fingerprint and
+            trust store generation.
+        """
+        intermediates = hashlib.sha256()
+        for fingerprint in sorted(
+                hashlib.sha256(crt.dump()).digest()
+                for crt in self.intermediates):
+            intermediates.update(fingerprint)
+        # Make sure the trust roots are (re)loaded before using the generation
+        TRUST_STORE.get_roots()
+        return (
+            hashlib.sha256(self.end_entity.dump()).digest(),
+            intermediates.digest(),
+            TRUST_STORE.generation
+        )
+
+    @property
+    def responder(self):
+        """
+        The host name of the OCSP responder that will be used for the next
+        renewal attempt.
+
+        :return str: Host name or None if the certificate has no OCSP URLs.
+        """
+        if not self.ocsp_urls:
+            return None
+        return urlparse(self.ocsp_urls[self.url_index]).hostname
+
     @property
-    @cache(None)
     def ocsp_request(self):
         """
-        Generate an OCSP request or return an already cached request.
+        Generate an OCSP request or return an already cached request. The
+        request is cached in the model itself, so it is released together
+        with the model.
 
         :return bytes: A binary representation of a
             :class:`asn1crypto.ocsp.OCSPRequest` which is in turn represented
             by a :class:`asn1crypto.core.Sequence`.
         """
+        if self._ocsp_request is not None:
+            return self._ocsp_request
         ocsp_request_builder = ocspbuilder.OCSPRequestBuilder(
             asymmetric.load_certificate(self.end_entity),
             asymmetric.load_certificate(self.chain[-2])
@@ -396,6 +795,9 @@ class CertModel(object):
                 "Request data: \n%s",
                 pretty_base64(ocsp_request, line_len=75, prefix=" "*36)
             )
+        self._ocsp_request = ocsp_request
+        # Anything left from parsing the certificate file is not needed now
+        self.crt_data = None
         return ocsp_request
 
     def __repr__(self):
@@ -5,14 +5,31 @@ certificate can be used to request OCSP responses. After parsing a new
 :class:`ocspd.core.taskcontext.OCSPTaskContext` is created for the
 :class:`ocspd.core.oscprenewe.OCSPRenewer` which is then scheduled to be
 processed ASAP.
+
+Parsing and validating certificates is CPU intensive, optionally it can be
+done by a pool of worker processes, in which case the parser thread only
+hands out work to the pool and processes the results.
+
+The same certificate can be found in several files, e.g. when it is deployed
+for several HAProxy instances. Only the first model of a certificate renews
+its staple, the other models become its aliases and get a copy of every
+staple.
+
+If a :class:`ocspd.core.statestore.StateStore` is passed, models of files that
+did not change since their state was saved are restored from it instead of
+being parsed and validated again.
 """
 
 import threading
 import logging
 import datetime
+import multiprocessing
 import queue
+from collections import deque
 from ocspd.core.excepthandler import ocsp_except_handle
 from ocspd.core.taskcontext import OCSPTaskContext
+from ocspd.core.certmodel import parse_crt_file
+from ocspd.core.certmodel import CHAIN_CACHE
 
 LOG = logging.getLogger(__name__)
 
@@ -36,12 +53,29 @@ class CertParserThread(threading.Thread):
             where we can get parser tasks from and add renew tasks to.
             **(required)**.
         :kwarg bool no_recycle: Don't recycle existing staples (default=False)
+        :kwarg int processes: Amount of worker processes to parse and validate
+            certificates with, 0 to do it in this thread (default=0).
+        :kwarg dict cert_ids: A dict to maintain the model that renews the
+            staple of a certificate by its
+            :attr:`~ocspd.core.certmodel.CertModel.cert_id` **(optional)**.
+        :kwarg threading.Lock cert_ids_lock: Lock shared with the finder that
+            guards ``cert_ids`` and the aliases of models **(optional)**.
+        :kwarg ocspd.core.statestore.StateStore state_store: Store to restore
+            models from and save parsed models to **(optional)**.
+        :kwarg bool proxy_add: Whether to add ``proxy-add`` tasks for new
+            staples, only when an :class:`ocspd.core.ocspadder.OCSPAdder`
+            takes them from the scheduler (default=True).
         """
         self.stop = False
         self.models = kwargs.pop('models', None)
         self.minimum_validity = kwargs.pop('minimum_validity', None)
         self.scheduler = kwargs.pop('scheduler', None)
         self.no_recycle = kwargs.pop('no_recycle', False)
+        self.processes = kwargs.pop('processes', 0)
+        self.cert_ids = kwargs.pop('cert_ids', {})
+        self.cert_ids_lock = kwargs.pop('cert_ids_lock', threading.Lock())
+        self.state_store = kwargs.pop('state_store', None)
+        self.proxy_add = kwargs.pop('proxy_add', True)
 
         assert self.models is not None, \
             "You need to pass a dict to hold the certificate model cache."
@@ -59,9 +93,15 @@ class CertParserThread(threading.Thread):
         Start the certificate parser thread.
         """
         LOG.info("Started a parser thread.")
+        if self.processes:
+            self._run_pool()
+            LOG.debug("Goodbye cruel world..")
+            return
         while not self.stop:
             try:
                 context = self.scheduler.get_task("parse", timeout=0.25)
+                # Changes to the file from now on need a new parse.
+                context.model.parse_pending = False
                 with ocsp_except_handle(context):
                     self.parse_certificate(context.model)
                 # If the parsing action fails, the error handler will
@@ -73,19 +113,127 @@ class CertParserThread(threading.Thread):
                 pass
         LOG.debug("Goodbye cruel world..")
 
-    def parse_certificate(self, model):
+    def _run_pool(self):
+        """
+        Hand out parse tasks to a pool of worker processes, keeping up to two
+        tasks per worker in progress, and process the results in the order
+        the tasks were taken from the queue.
+        """
+        LOG.info("Parsing with %d worker processes.", self.processes)
+        # Don't fork a process that runs a lot of threads.
+        pool = multiprocessing.get_context('spawn').Pool(self.processes)
+        pending = deque()
+        try:
+            while not self.stop:
+                while len(pending) < self.processes * 2:
+                    try:
+                        # Only wait for new tasks if there's nothing to do.
+                        context = self.scheduler.get_task(
+                            "parse", blocking=not pending, timeout=0.25)
+                    except queue.Empty:
+                        break
+                    # Changes to the file from now on need a new parse.
+                    context.model.parse_pending = False
+                    state = self._restore(context.model)
+                    if state is not None:
+                        # No need to bother the pool.
+                        with ocsp_except_handle(context):
+                            self.parse_certificate(context.model, state=state)
+                        self.scheduler.task_done("parse")
+                        continue
+                    result = pool.apply_async(
+                        parse_crt_file, (context.model.filename,))
+                    pending.append((context, result))
+                if not pending:
+                    continue
+                context, result = pending[0]
+                result.wait(0.25)
+                if not result.ready():
+                    continue
+                pending.popleft()
+                with ocsp_except_handle(context):
+                    self.parse_certificate(context.model, result.get())
+                self.scheduler.task_done("parse")
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _restore(self, model):
+        """
+        Get the saved state of a model, if there is a state store.
+
+        :param ocspd.core.certmodel.CertModel model: A model to parse.
+        :return dict: The saved state or None.
+        """
+        if self.state_store is None:
+            return None
+        return self.state_store.restore(model)
+
+    def parse_certificate(self, model, parse_result=None, state=None):
         """
         Parse certificate files and check whether an existing OCSP staple that
         is still valid exists. If so, use it, if not request a new OCSP staple.
         If the staple is valid but not valid for longer than the
         ``minimum_validity``, the staple is loaded but a new request is still
         scheduled.
+
+        :param ocspd.core.certmodel.CertModel model: The model to parse.
+        :param dict parse_result: The result of parsing the model in a worker
+            process, if not passed the model is parsed in this thread.
+        :param dict state: The saved state of the model, if not passed it is
+            looked up in the state store.
         """
-        LOG.info("Parsing certificate for file \"%s\"..", model)
-        # Parse the certificate
-        model.parse_crt_file()
+        if parse_result is None and state is None:
+            state = self._restore(model)
+        if state is not None:
+            LOG.info("Restoring certificate for file \"%s\"..", model)
+            restored = model.restore_state(state)
+        else:
+            LOG.info("Parsing certificate for file \"%s\"..", model)
+            # Parse the certificate
+            if parse_result is None:
+                model.parse_crt_file()
+            else:
+                model.apply_parse_result(parse_result)
+            LOG.debug(
+                "Validated chain cache: %d hits, %d misses, %d entries.",
+                CHAIN_CACHE.hits, CHAIN_CACHE.misses, len(CHAIN_CACHE)
+            )
+        with self.cert_ids_lock:
+            primary = self.cert_ids.get(model.cert_id)
+            if primary is not None and primary is not model and \
+                    self.models.get(primary.filename) is primary:
+                primary.add_alias(model)
+            else:
+                primary = None
+                self.cert_ids[model.cert_id] = model
+        if primary is not None:
+            LOG.info(
+                "File \"%s\" contains the same certificate as \"%s\", it "
+                "will get the same staples.", model, primary)
+            if model.ocsp_staple is not None and \
+                    model.write_ocsp_staple(model.ocsp_staple.data) and \
+                    self.proxy_add:
+                context = OCSPTaskContext(
+                    task_name="proxy-add", model=model, sched_time=None)
+                self._add_task(context)
+            if state is None and self.state_store is not None:
+                self.state_store.save(model)
+            return
+
+        if state is not None:
+            recycled = restored and not self.no_recycle
+        else:
+            recycled = not self.no_recycle and \
+                model.recycle_staple(self.minimum_validity)
+        # Smooth the renewal, unless it was smoothed before it was saved.
+        smooth = True
         # If there is a valid existing staple, use it..
-        if not self.no_recycle and model.recycle_staple(self.minimum_validity):
+        if recycled and state is not None and state['next_renewal']:
+            # Keep the renewal time that was scheduled before.
+            sched_time = state['next_renewal']
+            smooth = False
+        elif recycled:
             # There is a valid staple file, schedule a regular renewal
             until = model.ocsp_staple.valid_until
             sched_time = until - datetime.timedelta(
@@ -93,8 +241,25 @@ class CertParserThread(threading.Thread):
         else:
             # No existing staple file or invalid, renew ASAP.
             sched_time = None
+        if state is None and self.state_store is not None:
+            self.state_store.save(model, next_renewal=sched_time)
 
         # Schedule a renewal of the OCSP staple
         context = OCSPTaskContext(
             task_name="renew", model=model, sched_time=sched_time)
-        self.scheduler.add_task(context)
+        self._add_task(context, smooth=smooth)
+
+    def _add_task(self, context, smooth=False):
+        """
+        Add a task to the scheduler, wait for room in its queue if the queue
+        is full, unless the thread is stopped.
+
+        :param ocspd.core.taskcontext.OCSPTaskContext context: The task.
+        :param bool smooth: Let the scheduler smooth the scheduled time.
+        """
+        while not self.stop:
+            try:
+                self.scheduler.add_task(context, smooth=smooth, timeout=1)
+                return
+            except queue.Full:
+                LOG.debug("The %s queue is full, waiting..", context.task_name)
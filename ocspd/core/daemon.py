@@ -41,21 +41,41 @@ This module bootstraps the ocspd process by starting threads for:
   If any of these request stall for long, the entire daemon doesn't stop
   working until it is no longer stalled.
 
+  Alternatively, with ``--renewal-engine=asyncio``, 1x
+  :class:`ocspd.core.asyncrenewer.AsyncOCSPRenewerThread` is started that
+  does the same for many certificates at the same time in an event loop.
+
 - 1x :class:`ocspd.core.ocspadder.OCSPAdder` **(optional)**
 
   Takes tasks ``haproxy-add`` from the scheduler and communicates OCSP staples
   updates to HAProxy through a HAProxy socket.
 
+If ``--state-dir`` is set, the state of parsed certificates and their staples
+is kept in a :class:`ocspd.core.statestore.StateStore`, so after a restart
+unchanged certificates don't need to be parsed and validated again.
+
 """
+import functools
 import logging
+import operator
+import os
 import time
 import threading
 import signal
+import sqlite3
 from ocspd.core.certfinder import CertFinderThread
+from ocspd.core.asyncrenewer import AsyncOCSPRenewerThread
 from ocspd.core.certparser import CertParserThread
+from ocspd.core.certmodel import STAPLE_SYNC
 from ocspd.core.ocsprenewer import OCSPRenewerThread
+from ocspd.core.ocsprenewer import renew_priority
 from ocspd.core.ocspadder import OCSPAdder
+from ocspd.core.statestore import StateStore
+from ocspd.core.statestore import STATE_FILENAME
+from ocspd.core.truststore import TRUST_STORE
 from ocspd.scheduling import SchedulerThread
+from ocspd.scheduling import LoadSmoother
+from ocspd.util.sessionpool import SessionPool
 from ocspd import MAX_RESTART_THREADS
 
 LOG = logging.getLogger(__name__)
@@ -76,22 +96,66 @@ class OCSPDaemon(object):
         self.sockets = args.haproxy_sockets
         self.socket_paths = None
         if self.sockets:
-            if len(self.directories) != len(self.sockets):
-                raise ValueError("#sockets does not equal #directories")
-            # Make a mapping from directory to socket
-            self.socket_paths = dict(zip(self.directories, self.sockets))
+            # Directories that are only used to find the sockets of files
+            # from crt-lists and manifests follow the scanned directories.
+            directories = self.directories + args.socket_directories
+            if len(directories) != len(self.sockets):
+                raise ValueError(
+                    "#sockets does not equal #directories plus "
+                    "#socket-directories")
+            # Make a mapping from directory to sockets, a directory can be
+            # served by several HAProxy processes.
+            self.socket_paths = {
+                directory: [path for path in sockets.split(",") if path]
+                for directory, sockets in zip(directories, self.sockets)
+            }
         self.file_extensions = args.file_extensions.replace(" ", "").split(",")
         self.renewal_threads = args.renewal_threads
+        self.renewal_engine = args.renewal_engine
+        self.async_concurrency = args.async_concurrency
         self.refresh_interval = args.refresh_interval
+        self.ignore = args.ignore or []
+        self.inotify = args.inotify
+        self.full_rescan_interval = args.full_rescan_interval
+        self.scan_threads = args.scan_threads
+        self.recursion_depth = args.recursion_depth
+        self.crt_lists = args.crt_lists or []
+        self.crt_base = args.crt_base
+        self.manifests = args.manifests or []
+        self.scan_timeout = args.scan_timeout
         self.minimum_validity = args.minimum_validity
         self.no_recycle = args.no_recycle
+        self.parse_processes = args.parse_processes
+        self.smoothing_window = args.smoothing_window
+        self.smoothing_rate = args.smoothing_rate
+        self.max_responder_threads = args.max_responder_threads
+        self.queue_size = args.queue_size
+        # Sync written staple files to disk, and their directories in batches.
+        STAPLE_SYNC.interval = args.fsync_interval
         self.model_cache = {}
+        # The model that renews the staple for each certificate, shared by
+        # the finder and the parser.
+        self.cert_ids = {}
+        self.cert_ids_lock = threading.Lock()
+        self.state_store = None
+        if args.state_dir:
+            path = os.path.join(args.state_dir, STATE_FILENAME)
+            try:
+                os.makedirs(args.state_dir, exist_ok=True)
+                self.state_store = StateStore(path)
+            except (OSError, sqlite3.Error) as exc:
+                raise ValueError(
+                    "Can't open the state store {}: {}".format(path, exc))
+        # Keep connections to OCSP servers alive for all renewer threads.
+        self.session_pool = SessionPool(max_connections=self.renewal_threads)
         self.all_threads = []
         self.stop = False
 
         # Listen to SIGINT and SIGTERM
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        # Reload the trust roots on SIGHUP
+        signal.signal(signal.SIGHUP, self.reload_trust_roots)
 
         LOG.info(
             "Starting OCSP Stapling daemon, finding files of types: %s with "
@@ -109,8 +173,11 @@ class OCSPDaemon(object):
 
         # Start ocsp response gathering threads
         threads_list = []
-        for tid in range(0, self.renewal_threads):
-            threads_list.append(self.start_renewer_thread(tid))
+        if self.renewal_engine == 'asyncio':
+            threads_list.append(self.start_async_renewer_thread())
+        else:
+            for tid in range(0, self.renewal_threads):
+                threads_list.append(self.start_renewer_thread(tid))
 
         # Start certificate parser thread
         self.parser = self.start_parser_thread()
@@ -126,14 +193,57 @@ class OCSPDaemon(object):
         LOG.info("Exiting with signal number %d", signum)
         self.stop = True
 
+    @staticmethod
+    def reload_trust_roots(signum, _frame):
+        """
+        Reload the trust roots that are used for validating certificates the
+        next time they are needed.
+        """
+        LOG.info("Reloading trust roots on signal number %d", signum)
+        TRUST_STORE.reload()
+
     def start_scheduler_thread(self):
         """
         Spawns a scheduler thread with the appropriate keyword arguments.
+        If a smoothing window is set, renewals are spread over that window
+        before their deadline, at most ``smoothing_rate`` renewals per second
+        per OCSP responder.
+
+        The renew queue keeps renewals per OCSP responder and hands them out
+        per responder in turn, within a responder the most urgent renewals go
+        first, see :func:`ocspd.core.ocsprenewer.renew_priority`. At most
+        ``max_responder_threads`` renewals per responder are done at the same
+        time, so a slow responder can't occupy all renewer threads.
+
+        The proxy-add queue is only added when an OCSP adder takes tasks from
+        it. The parse and proxy-add queues hold at most ``queue_size`` tasks,
+        threads that add tasks to a full queue wait for room, so a large
+        backlog is kept in the scheduler instead of in memory of the later
+        stages. The renew queue is not bounded, otherwise a slow responder
+        could fill it and block renewals for all other responders, the
+        parse queue already limits how fast renewals are added.
         """
+        renew_queue = {
+            'name': "renew",
+            'group': operator.attrgetter('model.responder'),
+            'priority': functools.partial(
+                renew_priority, minimum_validity=self.minimum_validity),
+            'max_active': self.max_responder_threads
+        }
+        if self.smoothing_window:
+            renew_queue['smoother'] = LoadSmoother(
+                window=self.smoothing_window,
+                rate=self.smoothing_rate,
+                key=operator.attrgetter('model.filename'),
+                bucket=operator.attrgetter('model.responder')
+            )
+        queues = [{'name': "parse", 'max_size': self.queue_size}, renew_queue]
+        if self.socket_paths:
+            queues.append({'name': "proxy-add", 'max_size': self.queue_size})
         return self.__spawn_thread(
             name="scheduler",
             thread_object=SchedulerThread,
-            queues=["parse", "renew", "proxy-add"]
+            queues=queues
         )
 
     def start_ocsp_adder_thread(self):
@@ -145,7 +255,8 @@ class OCSPDaemon(object):
             name="proxy-adder",
             thread_object=OCSPAdder,
             socket_paths=self.socket_paths,
-            scheduler=self.scheduler
+            scheduler=self.scheduler,
+            models=self.model_cache
         )
 
     def start_finder_thread(self):
@@ -156,10 +267,23 @@ class OCSPDaemon(object):
             name="finder",
             thread_object=CertFinderThread,
             models=self.model_cache,
+            cert_ids=self.cert_ids,
+            cert_ids_lock=self.cert_ids_lock,
             directories=self.directories,
             refresh_interval=self.refresh_interval,
             file_extensions=self.file_extensions,
-            scheduler=self.scheduler
+            scheduler=self.scheduler,
+            ignore=self.ignore,
+            inotify=self.inotify,
+            full_rescan_interval=self.full_rescan_interval,
+            scan_threads=self.scan_threads,
+            scan_timeout=self.scan_timeout,
+            minimum_validity=self.minimum_validity,
+            recursion_depth=self.recursion_depth,
+            crt_lists=self.crt_lists,
+            crt_base=self.crt_base,
+            manifests=self.manifests,
+            state_store=self.state_store
         )
 
     def start_renewer_thread(self, tid):
@@ -170,7 +294,26 @@ class OCSPDaemon(object):
             name="renewer-{:02d}".format(tid),
             thread_object=OCSPRenewerThread,
             minimum_validity=self.minimum_validity,
-            scheduler=self.scheduler
+            scheduler=self.scheduler,
+            session_pool=self.session_pool,
+            state_store=self.state_store,
+            proxy_add=bool(self.socket_paths)
+        )
+
+    def start_async_renewer_thread(self):
+        """
+        Spawns an asyncio OCSP renewer thread with the appropriate keyword
+        arguments, it uses ``renewal_threads`` threads for validation.
+        """
+        return self.__spawn_thread(
+            name="renewer-async",
+            thread_object=AsyncOCSPRenewerThread,
+            minimum_validity=self.minimum_validity,
+            scheduler=self.scheduler,
+            concurrency=self.async_concurrency,
+            validation_threads=self.renewal_threads,
+            state_store=self.state_store,
+            proxy_add=bool(self.socket_paths)
         )
 
     def start_parser_thread(self):
@@ -181,9 +324,14 @@ class OCSPDaemon(object):
             name="parser",
             thread_object=CertParserThread,
             models=self.model_cache,
+            cert_ids=self.cert_ids,
+            cert_ids_lock=self.cert_ids_lock,
             minimum_validity=self.minimum_validity,
             no_recycle=self.no_recycle,
-            scheduler=self.scheduler
+            scheduler=self.scheduler,
+            processes=self.parse_processes,
+            state_store=self.state_store,
+            proxy_add=bool(self.socket_paths)
         )
 
     def monitor_threads(self):
@@ -222,6 +370,9 @@ class OCSPDaemon(object):
                         thread['object'],
                         thread['restarted']
                     )
+            if self.state_store is not None:
+                self.state_store.flush()
+            STAPLE_SYNC.flush()
             time.sleep(0.25)
 
         # This code is executed when self.stop is True
@@ -234,6 +385,20 @@ class OCSPDaemon(object):
                 thread.join()
             except RuntimeError:
                 pass  # cannot join current thread
+        for origin, stats in sorted(self.session_pool.stats.items()):
+            LOG.info(
+                "HTTP session statistics for %s: %d requests, %d errors, "
+                "%d sessions, %d idle evictions.",
+                origin,
+                stats['requests'],
+                stats['errors'],
+                stats['sessions'],
+                stats['evictions']
+            )
+        self.session_pool.close()
+        STAPLE_SYNC.flush(force=True)
+        if self.state_store is not None:
+            self.state_store.close()
         LOG.info("Stopping daemon thread")
 
     def __spawn_thread(self, name, thread_object, restarted=0, **kwargs):
@@ -48,12 +48,6 @@ from ocspd.core.exceptions import SocketError
 from future.standard_library import hooks
 with hooks():
     from urllib.error import URLError
-try:
-    _ = BrokenPipeError
-except NameError:
-    import socket
-    BrokenPipeError = socket.error
-
 LOG = logging.getLogger(__name__)
 
 #: This is a global variable that is overridden by ocspd.__main__ with
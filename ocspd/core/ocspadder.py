@@ -1,26 +1,130 @@
 # -*- coding: utf-8 -*-
 """
 Module for adding OCSP Staples to a running HAProxy instance.
+
+Staples are sent in batches: all ``proxy-add`` tasks that are waiting are
+taken from the scheduler at once, and the commands for each HAProxy socket are
+written to it in one go, one command per line. HAProxy answers every command
+with its response followed by a prompt, so the responses are split on the
+prompts and checked per certificate.
+
+A directory can be served by several HAProxy processes, each with its own
+socket, staples are then sent to all of them. All sockets are written to and
+read from at the same time in a :mod:`selectors` loop, every command must be
+answered within :attr:`OCSPAdder.COMMAND_TIMEOUT` seconds, so a HAProxy that
+hangs only delays the staples for its own socket. Sockets that time out or
+break are closed and opened again when they are used next.
+
+HAProxy forgets the staples that were added through its socket when it is
+restarted or reloaded. The output of ``show info`` is checked every
+:attr:`OCSPAdder.INFO_INTERVAL` seconds, and every time a socket is connected,
+e.g. because HAProxy closed an idle connection. When its ``Pid`` or
+``Uptime_sec`` shows that HAProxy was restarted, or a socket was connected
+again while its previous info is unknown, the current staples of all models
+for that socket are sent to it again in bulk.
 """
 import threading
 import logging
+import selectors
 import socket
 import errno
 import os
 import queue
-from io import StringIO
+import time
 from ocspd.core.excepthandler import ocsp_except_handle
 import ocspd.core.exceptions
 import ocspd.util.functions
 
-try:
-    _ = BrokenPipeError
-except NameError:
-    import socket
-    BrokenPipeError = socket.error
-
 LOG = logging.getLogger(__name__)
-SOCKET_BUFFER_SIZE = 1024
+SOCKET_BUFFER_SIZE = 64 * 1024
+
+#: The prompt HAProxy sends after the response to every command.
+PROMPT = "\n> "
+
+
+class _Exchange(object):
+    """
+    The state of sending a batch of commands to one socket and reading the
+    responses.
+    """
+    def __init__(self, path, sock, commands, skip=0):
+        """
+        :param str path: Path of the socket.
+        :param socket.socket sock: The connected socket.
+        :param list commands: The commands to send.
+        :param int skip: Amount of responses to leave out of the responses,
+            for commands that were added to the batch to set up the
+            connection.
+        """
+        self.path = path
+        self.sock = sock
+        self.expected = len(commands)
+        self.skip = skip
+        self.out = memoryview(
+            "".join(command + "\n" for command in commands).encode())
+        self.sent = 0
+        # The stream starts with a newline so every response is followed by
+        # a prompt, including the first one.
+        self.chunks = ["\n"]
+        self.tail = ""
+        self.prompts = 0
+        self.failed = False
+        self.timed_out = False
+        self.deadline = None
+
+    @property
+    def done(self):
+        """
+        True when all responses are read or the exchange failed.
+        """
+        return self.failed or self.prompts >= self.expected
+
+    def write(self):
+        """
+        Write as much of the commands as the socket accepts.
+
+        :return bool: True if all commands are written.
+        :raises OSError: If the socket is broken.
+        """
+        try:
+            self.sent += self.sock.send(self.out[self.sent:])
+        except (BlockingIOError, InterruptedError):
+            pass
+        return self.sent >= len(self.out)
+
+    def read(self):
+        """
+        Read the responses that are available on the socket.
+
+        :raises OSError: If the socket is broken or was closed by HAProxy.
+        """
+        try:
+            chunk = self.sock.recv(SOCKET_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not chunk:
+            raise ConnectionResetError(
+                errno.ECONNRESET, "Socket closed by HAProxy")
+        d_chunk = chunk.decode('ascii', 'replace')
+        self.chunks.append(d_chunk)
+        # A prompt may be split over two chunks.
+        self.prompts += (self.tail + d_chunk).count(PROMPT)
+        self.tail = (self.tail + d_chunk)[-len(PROMPT) + 1:]
+
+    def responses(self):
+        """
+        Split the received stream into responses.
+
+        :return list: The response to each command, responses that were not
+            received are empty strings.
+        """
+        # Strip *all* \n, > and space characters from the responses
+        responses = [
+            response.strip('\n> ')
+            for response in "".join(self.chunks).split(PROMPT)[:self.expected]
+        ]
+        responses.extend([''] * (self.expected - len(responses)))
+        return responses[self.skip:]
 
 
 class OCSPAdder(threading.Thread):
@@ -33,8 +137,8 @@ class OCSPAdder(threading.Thread):
 
     Tasks are taken from the :class:`ocspd.scheduling.SchedulerThread`, as soon
         as a task context is received, an OCSP response is read from the model
-        within it, it is added to a HAProxy socket found in
-        self.socks[<certificate directory>].
+        within it, it is added to the HAProxy sockets of the certificate's
+        directory, connected sockets are kept in self.socks[<socket path>].
 
     .. _collectd haproxy connection:
        https://github.com/wglass/collectd-haproxy/blob/master/collectd_haproxy/
@@ -48,23 +152,43 @@ class OCSPAdder(threading.Thread):
     #: the base64 encoded OCSP staple
     OCSP_ADD = 'set ssl ocsp-response {}'
 
+    #: Maximum amount of tasks taken from the scheduler at once.
+    BATCH_SIZE = 5000
+
+    #: Maximum amount of commands written to a socket before reading their
+    #: responses, so a broken socket doesn't fail too many tasks at once.
+    PIPELINE_SIZE = 500
+
+    #: Seconds to wait for a socket to connect.
+    CONNECT_TIMEOUT = 5
+
+    #: Seconds HAProxy may take to answer a command, counted from the last
+    #: progress on the socket.
+    COMMAND_TIMEOUT = 10
+
+    #: Seconds between checks of ``show info`` for HAProxy restarts.
+    INFO_INTERVAL = 30
+
     def __init__(self, *args, **kwargs):
         """
         Initialise the thread with its parent :class:`threading.Thread` and its
         arguments.
 
         :kwarg dict socket_paths: A mapping from a directory (typically the
-            directory containing TLS certificates) to a HAProxy socket that
-            serves certificates from that directory. These sockets are used to
-            communicate new OCSP staples to HAProxy, so it does not have to be
-            restarted.
+            directory containing TLS certificates) to a list of HAProxy
+            sockets that serve certificates from that directory. These sockets
+            are used to communicate new OCSP staples to HAProxy, so it does
+            not have to be restarted.
         :kwarg ocspd.scheduling.SchedulerThread scheduler: The scheduler object
             where we can get "haproxy-adder" tasks from **(required)**.
+        :kwarg dict models: The model cache, the staples of the models in it
+            are sent again to a HAProxy that was restarted **(optional)**.
         """
         self.stop = False
         LOG.debug("Starting OCSPAdder thread")
         self.scheduler = kwargs.pop('scheduler', None)
         self.socket_paths = kwargs.pop('socket_paths', None)
+        self.models = kwargs.pop('models', {})
 
         assert self.scheduler is not None, \
             "Please pass a scheduler to get and add proxy-add tasks."
@@ -72,33 +196,54 @@ class OCSPAdder(threading.Thread):
             "The OCSPAdder needs a socket_paths dict"
 
         self.socks = {}
-        with ocsp_except_handle():
-            for key, socket_path in self.socket_paths.items():
-                self._open_socket(key, socket_path)
+        #: Sockets that were connected at least once.
+        self._connected = set()
+        #: Sockets that need all staples again because HAProxy restarted.
+        self._resync = set()
+        #: Pid and uptime of each HAProxy by socket path.
+        self._info = {}
+        self._last_info_check = time.time()
+        # Open all sockets, sending no commands only asks for a prompt.
+        self.send_many_all({
+            socket_path: []
+            for paths in self.socket_paths.values()
+            for socket_path in paths
+        })
         super(OCSPAdder, self).__init__(*args, **kwargs)
 
-    def _open_socket(self, key, socket_path):
+    def _connect(self, socket_path):
         """
-        Opens a socket located at socket_path and saves it in self.socks[key].
-        Subsequently it asks for a prompt to keep the socket connection open,
-        so several commands can be sent without having to close and re-open the
+        Connect to a socket, the connected socket is non-blocking. The socket
+        still needs to be asked for a prompt to keep the connection open, so
+        several commands can be sent without having to close and re-open the
         socket.
 
-        :param key: the identifier of the socket in self.socks
         :param str socket_path: A valid HAProxy socket path.
-
+        :return socket.socket: The socket.
         :raises :exc:ocspd.core.exceptions.SocketError: when the socket can not
             be opened.
         """
-        self.socks[key] = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.CONNECT_TIMEOUT)
         try:
-            self.socks[key].connect(socket_path)
-        except FileNotFoundError as exc:
+            sock.connect(socket_path)
+        except (IOError, OSError) as exc:
+            sock.close()
             raise ocspd.core.exceptions.SocketError(
-                "Could not initialize OCSPAdder with socket {}: {}".format(
+                "Could not connect to HAProxy socket {}: {}".format(
                     socket_path, exc))
-        result = self.send(key, "prompt")
-        LOG.debug("Opened prompt with result: '%s'", result)
+        sock.setblocking(False)
+        return sock
+
+    def _close_socket(self, socket_path):
+        """
+        Close a socket, it is opened again when it is used next.
+
+        :param str socket_path: The socket's path.
+        """
+        sock = self.socks.pop(socket_path, None)
+        if sock is not None:
+            sock.close()
 
     def __del__(self):
         """
@@ -116,107 +261,356 @@ class OCSPAdder(threading.Thread):
         LOG.info("Started an OCSP adder thread.")
 
         while not self.stop:
+            if time.time() - self._last_info_check >= self.INFO_INTERVAL:
+                self.check_restarts()
+            if self._resync:
+                self.resync()
             try:
-                context = self.scheduler.get_task(self.TASK_NAME, timeout=0.25)
-                model = context.model
-                LOG.debug("Sending staple for cert:'%s'", model)
-
-                # Open the exception handler context to run tasks likely to fail
-                with ocsp_except_handle(context):
-                    self.add_staple(model)
-                self.scheduler.task_done(self.TASK_NAME)
+                contexts = [
+                    self.scheduler.get_task(self.TASK_NAME, timeout=0.25)]
             except queue.Empty:
-                pass
+                continue
+            while len(contexts) < self.BATCH_SIZE:
+                try:
+                    contexts.append(self.scheduler.get_task(
+                        self.TASK_NAME, blocking=False))
+                except queue.Empty:
+                    break
+            self.add_staples(contexts)
+            for _ in contexts:
+                self.scheduler.task_done(self.TASK_NAME)
+        for socket_path in list(self.socks):
+            self._close_socket(socket_path)
         LOG.debug("Goodbye cruel world..")
 
+    def add_staples(self, contexts):
+        """
+        Send the staples of a batch of ``proxy-add`` tasks to HAProxy. The
+        commands are pipelined and sent to all sockets at the same time.
+
+        :param list contexts: :class:`ocspd.core.taskcontext.OCSPTaskContext`
+            objects of ``proxy-add`` tasks.
+        """
+        by_socket = {}
+        for context in contexts:
+            LOG.debug("Sending staple for cert:'%s'", context.model)
+            # Open the exception handler context to run tasks likely to fail
+            with ocsp_except_handle(context):
+                socket_key = self._socket_key(context.model.filename)
+                for socket_path in self.socket_paths[socket_key]:
+                    by_socket.setdefault(socket_path, []).append(context)
+        failures = {}
+        start = 0
+        while by_socket:
+            batches = {}
+            for socket_path, socket_contexts in list(by_socket.items()):
+                batch = socket_contexts[start:start + self.PIPELINE_SIZE]
+                if not batch:
+                    del by_socket[socket_path]
+                    continue
+                batches[socket_path] = batch
+            start += self.PIPELINE_SIZE
+            responses = self.send_many_all({
+                socket_path: [self._add_command(ctx.model) for ctx in batch]
+                for socket_path, batch in batches.items()
+            })
+            for socket_path, batch in batches.items():
+                for context, response in zip(batch, responses[socket_path]):
+                    try:
+                        self._check_response(response)
+                    except ocspd.core.exceptions.OCSPAdderBadResponse as exc:
+                        failures.setdefault(context, []).append(
+                            "{}: {}".format(socket_path, exc))
+        for context, errors in failures.items():
+            with ocsp_except_handle(context):
+                raise ocspd.core.exceptions.OCSPAdderBadResponse(
+                    "Can't add staple for {} to {}".format(
+                        context.model, ", ".join(errors)))
+
+    def check_restarts(self):
+        """
+        Ask every connected HAProxy for its ``show info`` and remember its
+        ``Pid`` and ``Uptime_sec``, if the pid changed or the uptime went
+        down, HAProxy was restarted and its socket needs to be resynced.
+        """
+        self._last_info_check = time.time()
+        paths = list(self.socks)
+        if not paths:
+            return
+        responses = self.send_many_all({path: ["show info"] for path in paths})
+        for socket_path in paths:
+            self._check_info(socket_path, responses[socket_path][0])
+
+    def _check_info(self, socket_path, response, reconnected=False):
+        """
+        Remember the ``Pid`` and ``Uptime_sec`` of a HAProxy, and mark its
+        socket to be resynced if it was restarted.
+
+        :param str socket_path: Path of the socket.
+        :param str response: The response to ``show info``.
+        :param bool reconnected: Whether the socket was connected again, its
+            staples are then also resynced if its previous info is unknown.
+        """
+        info = {}
+        for line in response.splitlines():
+            key, _, value = line.partition(":")
+            info[key.strip()] = value.strip()
+        try:
+            current = (info['Pid'], int(info['Uptime_sec']))
+        except (KeyError, ValueError):
+            LOG.debug("No HAProxy info from socket %s", socket_path)
+            current = None
+        previous = self._info.get(socket_path)
+        if current is not None:
+            self._info[socket_path] = current
+        if previous is None or current is None:
+            if reconnected:
+                LOG.info(
+                    "Reconnected to HAProxy socket %s, it may have been "
+                    "restarted.", socket_path)
+                self._resync.add(socket_path)
+        elif current[0] != previous[0] or current[1] < previous[1]:
+            LOG.info(
+                "HAProxy on socket %s was restarted (pid %s).",
+                socket_path, current[0])
+            self._resync.add(socket_path)
+
+    def resync(self):
+        """
+        Send the current staples of all models to the sockets of HAProxy
+        processes that were restarted.
+        """
+        paths = self._resync
+        self._resync = set()
+        by_socket = dict((socket_path, []) for socket_path in paths)
+        for model in list(self.models.values()):
+            if model.ocsp_staple is None:
+                continue
+            try:
+                socket_key = self._socket_key(model.filename)
+            except ocspd.core.exceptions.SocketError:
+                continue
+            for socket_path in self.socket_paths[socket_key]:
+                if socket_path in by_socket:
+                    by_socket[socket_path].append(model)
+        counts = dict((socket_path, [0, 0]) for socket_path in paths)
+        start = 0
+        while any(len(models) > start for models in by_socket.values()):
+            batches = {}
+            for socket_path, models in by_socket.items():
+                batch = models[start:start + self.PIPELINE_SIZE]
+                if batch:
+                    batches[socket_path] = [
+                        self._add_command(model) for model in batch]
+            start += self.PIPELINE_SIZE
+            responses = self.send_many_all(batches)
+            for socket_path, socket_responses in responses.items():
+                for response in socket_responses:
+                    try:
+                        self._check_response(response)
+                        counts[socket_path][0] += 1
+                    except ocspd.core.exceptions.OCSPAdderBadResponse:
+                        counts[socket_path][1] += 1
+        for socket_path, (done, failed) in counts.items():
+            LOG.info(
+                "Resynced %d staples to HAProxy socket %s, %d failed.",
+                done, socket_path, failed)
+
     def add_staple(self, model):
         """
         Create and send the command that adds a base64 encoded OCSP staple to
-        the HAProxy
+        the HAProxy sockets of the model's directory.
 
         :param model: An object that has a binary string `ocsp_staple` in it
             and a filename `filename`.
         """
+        command = self._add_command(model)
+        responses = self.send_many_all({
+            socket_path: [command]
+            for socket_path in self.socket_paths[
+                self._socket_key(model.filename)]
+        })
+        for response in responses.values():
+            self._check_response(response[0])
+
+    def _add_command(self, model):
+        """
+        Create the command that adds the OCSP staple of a model to HAProxy.
+
+        :param model: An object that has a binary string `ocsp_staple` in it.
+        :return str: The command.
+        """
         command = self.OCSP_ADD.format(
             ocspd.util.functions.base64(model.ocsp_staple.data))
         LOG.debug("Setting OCSP staple with command '%s'", command)
-        directory = os.path.dirname(model.filename)
-        response = self.send(directory, command)
+        return command
+
+    @staticmethod
+    def _check_response(response):
+        """
+        Check HAProxy's response to a command that adds an OCSP staple.
+
+        :param str response: The response.
+        :raises ocspd.core.exceptions.OCSPAdderBadResponse: If HAProxy didn't
+            update the staple.
+        """
         if response != 'OCSP Response updated!':
             raise ocspd.core.exceptions.OCSPAdderBadResponse(
                 "Bad HAProxy response: {}".format(response))
 
-    def send(self, socket_key, command):
+    def _socket_key(self, filename):
         """
-        Send the command through self.socks[socket_key] (using
-        self.socket_paths)
+        Find the sockets for a certificate file, which are the sockets of the
+        directory that contains the file, or of the closest parent directory
+        that has sockets, because certificates can be found in
+        subdirectories.
 
-        :param str socket_key: Identifying dictionary key of the socket. This
-            is typically the directory HAProxy serves certificates from.
-        :param str command: String with the HAProxy command. For a list of
-            possible commands, see the `haproxy documentation`_
+        :param str filename: Path of a certificate file.
+        :return str: The key of the sockets in self.socket_paths.
+        :raises ocspd.core.exceptions.SocketError: When there is no socket for
+            the file.
+        """
+        directory = os.path.dirname(filename)
+        while directory not in self.socket_paths:
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                raise ocspd.core.exceptions.SocketError(
+                    "No HAProxy socket for {}".format(filename))
+            directory = parent
+        return directory
 
-        :raises IOError if an error occurs and it's not errno.EAGAIN or
-            errno.EINTR
+    def send(self, socket_path, command):
+        """
+        Send the command through self.socks[socket_path].
+
+        :param str socket_path: Path of the socket.
+        :param str command: String with the HAProxy command.
+        :return str: The response.
+        """
+        return self.send_many_all({socket_path: [command]})[socket_path][0]
+
+    def send_many_all(self, batches):
+        """
+        Send several commands to each of several sockets at once, and read all
+        of their responses. Sockets that are not connected are connected
+        first and asked for ``show info``, a socket that turns out to be
+        broken before anything was received from it is connected again and
+        gets its commands again.
+
+        :param dict batches: Lists of strings with HAProxy commands, by socket
+            path. For a list of possible commands, see the
+            `haproxy documentation`_
+        :return dict: A list with the response to each command by socket path,
+            missing responses, e.g. because HAProxy did not answer in time,
+            are empty strings.
 
         .. _haproxy documentation:
             http://haproxy.tech-notes.net/9-2-unix-socket-commands/
-
         """
-        # Empty buffer first, it's possible that other commands have been fired
-        # to the same socket, we don't want the response to those commands in
-        # our response string.
-        # FIXME: This would be nice, but is tricky because the socket seems to
-        # close if the recv call times out. Otherwise the socket stays open but
-        # the recv call is blocking...
-        # If this problem occurs, the easiest way is probably to open a socket
-        # each time we want to communicate...
-        # while True:
-        #     try:
-        #         chunk = self.socks[socket_key].recv(SOCKET_BUFFER_SIZE)
-        #         if not chunk:
-        #             break
-        #     except IOError as err:
-        #         if err.errno not in (errno.EAGAIN, errno.EINTR):
-        #             raise
-        #         else:
-        #             break
-
-        # Send command
-        with ocsp_except_handle():
-            try:
-                self.socks[socket_key].sendall((command + "\n").encode())
-            except BrokenPipeError:
-                # Try to re-open the socket. If that doesn't work, that will
-                # raise a :exc:`~ocspd.core.exceptions.SocketError`
-                LOG.warning("Re-opening socket %s", socket_key)
-                self.socks[socket_key].close()
-                self._open_socket(socket_key, self.socket_paths[socket_key])
-                # Try again, if this results in a BrokenPipeError *again*, it
-                # will be caught by ocsp_except_handle
-                self.socks[socket_key].sendall((command + "\n").encode())
-
-        buff = StringIO()
-
-        # Get new response.
-        while True:
+        # Sockets that were connected before may have been closed by HAProxy
+        # since, those are retried once with a new connection.
+        retry = {}
+        socks = {}
+        sending = {}
+        for socket_path, commands in batches.items():
+            if socket_path in self.socks:
+                retry[socket_path] = commands
+                socks[socket_path] = self.socks[socket_path]
+                sending[socket_path] = commands
+                continue
             try:
-                chunk = self.socks[socket_key].recv(SOCKET_BUFFER_SIZE)
-                if chunk:
-                    d_chunk = chunk.decode('ascii')
-                    buff.write(d_chunk)
-                    # TODO: Find out what happens if several threads are
-                    # talking to HAProxy on this socket
-                    if '> ' in d_chunk:
-                        break
+                socks[socket_path] = self._connect(socket_path)
+            except ocspd.core.exceptions.SocketError as exc:
+                LOG.critical(exc)
+                continue
+            # Enter prompt mode on the new connection first, and check
+            # whether HAProxy was restarted.
+            sending[socket_path] = ["prompt", "show info"] + commands
+        results = self._communicate(sending, socks)
+        for socket_path in sending:
+            if socket_path in retry or results[socket_path] is None:
+                continue
+            # The first response on a new connection is the info.
+            info = results[socket_path].pop(0)
+            if socket_path in self.socks:
+                self._check_info(
+                    socket_path, info,
+                    reconnected=socket_path in self._connected)
+                self._connected.add(socket_path)
+        retry = {
+            socket_path: commands for socket_path, commands in retry.items()
+            if results[socket_path] is None
+        }
+        if retry:
+            results.update(self.send_many_all(retry))
+        for socket_path, commands in batches.items():
+            if results.get(socket_path) is None:
+                results[socket_path] = [''] * len(commands)
+        return results
+
+    def _communicate(self, batches, socks):
+        """
+        Write the commands to the sockets and read the responses, for all
+        sockets at the same time.
+
+        :param dict batches: Lists of commands by socket path, if the first
+            command is ``prompt`` its response is left out.
+        :param dict socks: Connected sockets by socket path.
+        :return dict: A list of responses by socket path, None for sockets that
+            broke before anything was received from them. Sockets that time
+            out or break are closed.
+        """
+        selector = selectors.DefaultSelector()
+        now = time.time()
+        for socket_path, sock in socks.items():
+            commands = batches[socket_path]
+            exchange = _Exchange(
+                socket_path, sock, commands,
+                skip=1 if commands[:1] == ["prompt"] else 0)
+            exchange.deadline = now + self.COMMAND_TIMEOUT
+            selector.register(
+                sock, selectors.EVENT_READ | selectors.EVENT_WRITE, exchange)
+        results = {}
+        while selector.get_map():
+            exchanges = [key.data for key in selector.get_map().values()]
+            timeout = max(
+                0, min(exchange.deadline for exchange in exchanges) - now)
+            for key, events in selector.select(timeout):
+                exchange = key.data
+                try:
+                    if events & selectors.EVENT_WRITE and exchange.write():
+                        selector.modify(
+                            exchange.sock, selectors.EVENT_READ, exchange)
+                    if events & selectors.EVENT_READ:
+                        exchange.read()
+                except (IOError, OSError) as exc:
+                    LOG.error(
+                        "Error on HAProxy socket %s: %s", exchange.path, exc)
+                    exchange.failed = True
                 else:
-                    break
-            except IOError as err:
-                if err.errno not in (errno.EAGAIN, errno.EINTR):
-                    raise
-
-        # Strip *all* \n, > and space characters from the end
-        response = buff.getvalue().strip('\n> ')
-        buff.close()
-        LOG.debug("Received HAProxy response '%s'", response)
-        return response
+                    exchange.deadline = time.time() + self.COMMAND_TIMEOUT
+            now = time.time()
+            for exchange in exchanges:
+                if not exchange.done and exchange.deadline <= now:
+                    LOG.error(
+                        "HAProxy socket %s did not answer within %d seconds.",
+                        exchange.path, self.COMMAND_TIMEOUT)
+                    exchange.failed = exchange.timed_out = True
+                if not exchange.done:
+                    continue
+                selector.unregister(exchange.sock)
+                if exchange.failed:
+                    self._close_socket(exchange.path)
+                    exchange.sock.close()
+                else:
+                    self.socks[exchange.path] = exchange.sock
+                if exchange.failed and not exchange.timed_out and \
+                        exchange.prompts == 0:
+                    results[exchange.path] = None
+                else:
+                    results[exchange.path] = exchange.responses()
+                LOG.debug(
+                    "Received HAProxy responses from %s '%s'",
+                    exchange.path, results[exchange.path])
+        selector.close()
+        return results
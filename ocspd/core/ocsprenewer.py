@@ -20,6 +20,35 @@ from ocspd.core.excepthandler import ocsp_except_handle
 
 LOG = logging.getLogger(__name__)
 
+#: Priority lane for certificates that don't have a staple yet.
+LANE_MISSING = 0
+#: Priority lane for staples that are (almost) expired.
+LANE_EXPIRING = 1
+#: Priority lane for regular renewals of staples that are still valid.
+LANE_ROUTINE = 2
+
+
+def renew_priority(context, minimum_validity):
+    """
+    Determine the priority of a renew task, renewals are handed out per
+    lane (missing staples first, then expiring staples, then routine
+    renewals) and within a lane the staple that expires first goes first.
+
+    :param ocspd.core.taskcontext.OCSPTaskContext context: A renew task.
+    :param int minimum_validity: The amount of seconds a staple should still
+        be valid for to be considered a routine renewal.
+    :return tuple: Lane and expiry time of the staple.
+    """
+    staple = context.model.ocsp_staple
+    if staple is None:
+        return (LANE_MISSING, datetime.datetime.min)
+    until = staple.valid_until
+    expiring = datetime.datetime.now() + datetime.timedelta(
+        seconds=minimum_validity)
+    if until <= expiring:
+        return (LANE_EXPIRING, until)
+    return (LANE_ROUTINE, until)
+
 
 class OCSPRenewerThread(threading.Thread):
     """
@@ -40,10 +69,20 @@ class OCSPRenewerThread(threading.Thread):
             staple **(required)**.
         :kwarg ocspd.scheduling.SchedulerThread scheduler: The scheduler object
             where we can get tasks from and add new tasks to. **(required)**.
+        :kwarg ocspd.util.sessionpool.SessionPool session_pool: A pool of
+            HTTP sessions shared by the renewer threads **(optional)**.
+        :kwarg ocspd.core.statestore.StateStore state_store: Store to save the
+            state of renewed models in **(optional)**.
+        :kwarg bool proxy_add: Whether to add ``proxy-add`` tasks for new
+            staples, only when an :class:`ocspd.core.ocspadder.OCSPAdder`
+            takes them from the scheduler (default=True).
         """
         self.stop = False
         self.minimum_validity = kwargs.pop('minimum_validity', None)
         self.scheduler = kwargs.pop('scheduler', None)
+        self.session_pool = kwargs.pop('session_pool', None)
+        self.state_store = kwargs.pop('state_store', None)
+        self.proxy_add = kwargs.pop('proxy_add', True)
 
         assert self.minimum_validity is not None, \
             "You need to pass the minimum_validity."
@@ -64,32 +103,80 @@ class OCSPRenewerThread(threading.Thread):
                 with ocsp_except_handle(context):
                     model = context.model
                     LOG.info("Renewing OCSP staple for \"%s\"..", model)
-                    model.renew_ocsp_staple()
-                    self.scheduler.task_done("renew")
-
-                    # DEBUG scheduling, schedule 10 seconds in the future.
-                    # self.schedule_renew(context, 10)
-                    self.schedule_renew(model)
-
-                    # Adds the proxy-add command to the scheduler to run ASAP.
-                    # This updates the running HAProxy instance's OCSP staple
-                    # by running `set ssl ocsp-response {}`
-                    proxy_add_context = OCSPTaskContext(
-                        task_name="proxy-add", model=model, sched_time=None)
-                    self.scheduler.add_task(proxy_add_context)
+                    changed = model.renew_ocsp_staple(self.session_pool)
+                    self.renewed(model, changed)
+                # Also mark failed renewals done, so the responder's slot in
+                # the renew queue is freed up.
+                self.scheduler.task_done("renew", context)
             except queue.Empty:
                 pass
         LOG.debug("Goodbye cruel world..")
 
+    def renewed(self, model, changed=True):
+        """
+        Schedule the next renewal of a model that just got a new staple, and
+        tell the proxy about the new staple, unless it is the same staple the
+        proxy already has.
+
+        :param ocspd.core.certmodel.CertModel model: The renewed model.
+        :param bool changed: False if the OCSP server returned the staple that
+            was already in the staple file.
+        """
+        # DEBUG scheduling, schedule 10 seconds in the future.
+        # self.schedule_renew(context, 10)
+        next_renewal = self.schedule_renew(model)
+        if self.state_store is not None:
+            self.state_store.save(model, next_renewal=next_renewal)
+
+        # Adds the proxy-add command to the scheduler to run ASAP.
+        # This updates the running HAProxy instance's OCSP staple
+        # by running `set ssl ocsp-response {}`
+        if changed and self.proxy_add:
+            proxy_add_context = OCSPTaskContext(
+                task_name="proxy-add", model=model, sched_time=None)
+            self._add_task(proxy_add_context)
+
+        # Files with the same certificate get the same staple.
+        for alias in list(model.aliases):
+            alias.ocsp_staple = model.ocsp_staple
+            try:
+                if not alias.write_ocsp_staple(model.ocsp_staple.data):
+                    continue
+            except (IOError, OSError) as exc:
+                LOG.error("Can't write staple for %s: %s", alias, exc)
+                continue
+            if self.proxy_add:
+                proxy_add_context = OCSPTaskContext(
+                    task_name="proxy-add", model=alias, sched_time=None)
+                self._add_task(proxy_add_context)
+            if self.state_store is not None:
+                self.state_store.save(alias)
+
+    def _add_task(self, context):
+        """
+        Add a task to the scheduler to run ASAP, wait for room in its queue
+        if the queue is full, unless the thread is stopped.
+
+        :param ocspd.core.taskcontext.OCSPTaskContext context: The task.
+        """
+        while not self.stop:
+            try:
+                self.scheduler.add_task(context, timeout=1)
+                return
+            except queue.Full:
+                LOG.debug("The %s queue is full, waiting..", context.task_name)
+
     def schedule_renew(self, model, sched_time=None):
         """
         Schedule to renew this certificate's OCSP staple in ``sched_time``
-        seconds.
+        seconds. The renewal may be scheduled earlier if renewal load
+        smoothing is enabled in the scheduler.
 
         :param ocspd.core.certmodel.CertModel context: CertModel
             instance None to calculate it automatically.
         :param int shed_time: Amount of seconds to wait for renewal or None
             to calculate it automatically.
+        :return datetime.datetime: The scheduled time of the renewal.
         :raises ValueError: If ``context.ocsp_staple.valid_until`` is None
         """
         if not sched_time:
@@ -103,4 +190,6 @@ class OCSPRenewerThread(threading.Thread):
         # Make a fresh task context to reset exception counters
         new_context = OCSPTaskContext(
             task_name="renew", model=model, sched_time=sched_time)
-        self.scheduler.add_task(new_context)
+        # Let the scheduler spread renewals that are due at the same time.
+        self.scheduler.add_task(new_context, smooth=True)
+        return new_context.sched_time
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps the state of parsed certificate files in an SQLite database,
+so it survives restarts of the daemon.
+
+For every certificate file the status signature of the file, the result of
+parsing and validating it, the OCSP request, and the digest and expiry of its
+current staple are stored, as well as the time its next renewal is due. At
+startup the :class:`ocspd.core.certparser.CertParserThread` restores the
+models of files that did not change from the store, so they don't have to be
+parsed and validated again, and their renewals are scheduled right away. A
+file whose status changed, e.g. because it was touched, is compared by the
+digest of its content.
+
+The state of a file is looked up by its file name when the file is parsed, so
+the store is never loaded into memory as a whole. Intermediate and other CA
+certificates are usually shared by many files, so they are stored only once,
+by their SHA-256 fingerprint. After the first full scan of the certificate
+directories, the state of files that no longer exist is removed.
+
+Writes are committed at most once every ``commit_interval`` seconds, so many
+changes in a short time, e.g. during a mass renewal, are committed together.
+"""
+import base64
+import datetime
+import hashlib
+import logging
+import json
+import sqlite3
+import threading
+import time
+from ocspd.core.certmodel import file_digest
+
+LOG = logging.getLogger(__name__)
+
+#: The name of the database file in the state directory.
+STATE_FILENAME = "ocspd-state.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS intermediates (
+    fingerprint TEXT PRIMARY KEY,
+    der BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS certificates (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    parse_result TEXT NOT NULL,
+    ocsp_request BLOB,
+    staple_digest BLOB,
+    staple_until TEXT,
+    next_renewal TEXT
+);
+"""
+
+
+def _fingerprint(der):
+    """
+    :param bytes der: A DER encoded certificate.
+    :return str: The hex SHA-256 fingerprint of the certificate.
+    """
+    return hashlib.sha256(der).hexdigest()
+
+
+def _encode_result(result):
+    """
+    Encode the result of :meth:`ocspd.core.certmodel.CertModel.parse_result`
+    as JSON. Only the end entity certificate is included, the other
+    certificates are referred to by their fingerprint.
+
+    :param dict result: A parse result.
+    :return tuple: JSON, and the DER encoded certificates it refers to by
+        fingerprint.
+    """
+    def encode(der):
+        return base64.b64encode(der).decode('ascii')
+    certificates = {}
+    for der in result['intermediates'] + result['chain']:
+        if der != result['end_entity']:
+            certificates[_fingerprint(der)] = der
+    return json.dumps({
+        'digest': encode(result['digest']),
+        'end_entity': encode(result['end_entity']),
+        'intermediate_fingerprints': [
+            _fingerprint(der) for der in result['intermediates']
+        ],
+        'ocsp_urls': result['ocsp_urls'],
+        'chain_fingerprints': result['chain_fingerprints'],
+    }), certificates
+
+
+def _decode_result(data, lookup):
+    """
+    Decode a parse result that was encoded by :func:`_encode_result`.
+
+    :param str data: JSON.
+    :param callable lookup: Gets a DER encoded certificate by fingerprint.
+    :return dict: A parse result.
+    :raises KeyError: If a certificate that is referred to is not stored.
+    """
+    result = json.loads(data)
+    decode = base64.b64decode
+    result['digest'] = decode(result['digest'])
+    result['end_entity'] = decode(result['end_entity'])
+    result['intermediates'] = [
+        lookup(fingerprint)
+        for fingerprint in result.pop('intermediate_fingerprints')
+    ]
+    end_entity = _fingerprint(result['end_entity'])
+    result['chain'] = [
+        result['end_entity'] if fingerprint == end_entity
+        else lookup(fingerprint)
+        for fingerprint in result['chain_fingerprints']
+    ]
+    return result
+
+
+def _encode_time(value):
+    """
+    :param datetime.datetime value: A time or None.
+    :return str: The time in ISO format or None.
+    """
+    return None if value is None else value.isoformat()
+
+
+def _decode_time(value):
+    """
+    :param str value: A time in ISO format or None.
+    :return datetime.datetime: The time or None.
+    """
+    return None if value is None else datetime.datetime.fromisoformat(value)
+
+
+class StateStore(object):
+    """
+    Stores the state of certificate models in an SQLite database. The stored
+    state of a file is looked up by file name when its model is restored.
+
+    The store can be used from several threads.
+    """
+    def __init__(self, path, commit_interval=1):
+        """
+        Open or create the database.
+
+        :param str path: Path of the database file.
+        :param int|float commit_interval: Minimum amount of seconds between
+            commits (default=1).
+        :raises sqlite3.Error: If the database can't be opened.
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._last_commit = time.time()
+        self._dirty = False
+        #: Fingerprints of certificates that are known to be stored.
+        self._stored = set()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        LOG.info("Opened the state store %s.", path)
+
+    def restore(self, model):
+        """
+        Get the stored state of a model's file, if the file did not change
+        since it was stored. If only the file's status changed, e.g. because
+        it was touched, but its content is the same, the stored status is
+        updated and the state is restored.
+
+        :param ocspd.core.certmodel.CertModel model: A model that was not
+            parsed yet.
+        :return dict: The ``parse_result``, ``ocsp_request``,
+            ``staple_digest``, ``staple_until`` and ``next_renewal``, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, inode, mtime_ns, parse_result, ocsp_request, "
+                "staple_digest, staple_until, next_renewal FROM certificates "
+                "WHERE filename = ?", (model.filename,)).fetchone()
+        if row is None:
+            return None
+        if tuple(row[0:3]) != model.stat_signature:
+            try:
+                digest = base64.b64decode(json.loads(row[3])['digest'])
+                if file_digest(model.filename) != digest:
+                    return None
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                return None
+            LOG.debug(
+                "File %s was touched but its content is unchanged.",
+                model.filename)
+            self.update_status(model)
+        with self._lock:
+            try:
+                return {
+                    'parse_result': _decode_result(row[3], self._lookup),
+                    'ocsp_request': row[4],
+                    'staple_digest': row[5],
+                    'staple_until': _decode_time(row[6]),
+                    'next_renewal': _decode_time(row[7]),
+                }
+            except (ValueError, KeyError, TypeError) as exc:
+                LOG.warning(
+                    "Can't restore the state of %s: %s", model.filename, exc)
+                return None
+
+    def update_status(self, model):
+        """
+        Store the current status signature of a model's file, whose content
+        did not change.
+
+        :param ocspd.core.certmodel.CertModel model: The file's model.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE certificates SET size = ?, inode = ?, mtime_ns = ? "
+                "WHERE filename = ?",
+                tuple(model.stat_signature) + (model.filename,))
+            self._dirty = True
+            self._commit_if_due()
+
+    def _lookup(self, fingerprint):
+        """
+        Get a stored certificate.
+
+        .. Note:: Must be called while holding :attr:`_lock`.
+
+        :param str fingerprint: The certificate's SHA-256 fingerprint.
+        :return bytes: The DER encoded certificate.
+        :raises KeyError: If the certificate is not stored.
+        """
+        row = self._conn.execute(
+            "SELECT der FROM intermediates WHERE fingerprint = ?",
+            (fingerprint,)).fetchone()
+        if row is None:
+            raise KeyError("Certificate {} is not stored".format(fingerprint))
+        self._stored.add(fingerprint)
+        return row[0]
+
+    def save(self, model, next_renewal=None):
+        """
+        Store the state of a parsed model.
+
+        :param ocspd.core.certmodel.CertModel model: A parsed model.
+        :param datetime.datetime next_renewal: When the next renewal of the
+            model's staple is due.
+        """
+        state = model.saved_state()
+        parse_result, certificates = _encode_result(state['parse_result'])
+        row = (
+            model.filename,
+            model.stat_signature[0],
+            model.stat_signature[1],
+            model.stat_signature[2],
+            parse_result,
+            state['ocsp_request'],
+            state['staple_digest'],
+            _encode_time(state['staple_until']),
+            _encode_time(next_renewal),
+        )
+        with self._lock:
+            for fingerprint, der in certificates.items():
+                if fingerprint in self._stored:
+                    continue
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO intermediates VALUES (?, ?)",
+                    (fingerprint, der))
+                self._stored.add(fingerprint)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO certificates VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self._dirty = True
+            self._commit_if_due()
+
+    def forget(self, filename):
+        """
+        Remove the state of a file, e.g. because it was deleted.
+
+        :param str filename: Path of the file.
+        """
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM certificates WHERE filename = ?", (filename,))
+            self._dirty = True
+            self._commit_if_due()
+
+    def prune(self, filenames):
+        """
+        Remove the state of all files that are not in ``filenames``, and the
+        certificates that no stored file refers to anymore. This is meant to
+        be called once, after the first full scan of the certificate
+        directories, to remove the state of files that were deleted while
+        the daemon was not running.
+
+        :param set filenames: Paths of the files that exist.
+        """
+        with self._lock:
+            gone = [
+                (filename,) for (filename,) in self._conn.execute(
+                    "SELECT filename FROM certificates")
+                if filename not in filenames
+            ]
+            self._conn.executemany(
+                "DELETE FROM certificates WHERE filename = ?", gone)
+            used = set()
+            for (data,) in self._conn.execute(
+                    "SELECT parse_result FROM certificates"):
+                try:
+                    result = json.loads(data)
+                    used.update(result['intermediate_fingerprints'])
+                    used.update(result['chain_fingerprints'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+            unused = [
+                (fingerprint,) for (fingerprint,) in self._conn.execute(
+                    "SELECT fingerprint FROM intermediates")
+                if fingerprint not in used
+            ]
+            self._conn.executemany(
+                "DELETE FROM intermediates WHERE fingerprint = ?", unused)
+            self._stored.intersection_update(used)
+            self._conn.commit()
+            self._dirty = False
+            self._last_commit = time.time()
+        LOG.info(
+            "Removed the state of %d files that no longer exist, and %d "
+            "certificates that are no longer used.", len(gone), len(unused))
+
+    def flush(self):
+        """
+        Commit any uncommitted changes if the last commit was more than
+        ``commit_interval`` seconds ago.
+        """
+        with self._lock:
+            self._commit_if_due()
+
+    def _commit_if_due(self):
+        """
+        Commit uncommitted changes if the last commit was more than
+        ``commit_interval`` seconds ago.
+
+        .. Note:: Must be called while holding :attr:`_lock`.
+        """
+        now = time.time()
+        if self._dirty and now - self._last_commit >= self.commit_interval:
+            self._conn.commit()
+            self._dirty = False
+            self._last_commit = now
+
+    def close(self):
+        """
+        Commit any uncommitted changes and close the database.
+        """
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
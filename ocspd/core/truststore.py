@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps the trusted root certificates that are used to validate
+certificate chains. Loading and parsing the operating system's trust roots is
+relatively expensive, so they are loaded once per process and shared by all
+validations. Every validation gets a fresh
+:class:`certvalidator.ValidationContext` with the shared roots, any OCSP
+staple that should be taken into account is added to that context only.
+
+The roots are reloaded on demand, e.g. when the daemon receives a ``SIGHUP``,
+or when the modification time of the trust bundle changes.
+"""
+import logging
+import os
+import threading
+import time
+import asn1crypto.pem
+import asn1crypto.x509
+import certvalidator
+from oscrypto import trust_list
+
+LOG = logging.getLogger(__name__)
+
+
+class TrustStore(object):
+    """
+    Loads the trust roots from a PEM bundle once and hands out validation
+    contexts that use them. Each load increases :attr:`generation`, so
+    anything that depends on the trust roots can tell whether they changed.
+    """
+
+    #: Minimum amount of seconds between checks of the bundle's modification
+    #: time.
+    CHECK_INTERVAL = 60
+
+    def __init__(self, path=None):
+        """
+        Initialise the trust store, the roots are loaded when they are first
+        needed.
+
+        :param str path: Path to a PEM bundle with trust roots, defaults to
+            the operating system's trust roots.
+        """
+        self.path = path
+        self.roots = None
+        #: Increased every time the trust roots are (re)loaded.
+        self.generation = 0
+        self._mtime = None
+        self._last_check = 0
+        self._reload = False
+        self._lock = threading.Lock()
+
+    def reload(self):
+        """
+        Reload the trust roots the next time they are needed. This only sets
+        a flag so it is safe to call from a signal handler.
+        """
+        self._reload = True
+
+    def get_roots(self):
+        """
+        Get the trust roots, (re)load them first if they were not loaded yet,
+        if a reload was requested or if the bundle changed.
+
+        :return tuple: :class:`asn1crypto.x509.Certificate` objects.
+        """
+        now = time.time()
+        with self._lock:
+            if self.roots is None or self._reload:
+                self._load()
+            elif now - self._last_check > self.CHECK_INTERVAL:
+                self._last_check = now
+                try:
+                    mtime = os.path.getmtime(self._bundle_path())
+                except (IOError, OSError):
+                    mtime = None
+                if mtime != self._mtime:
+                    LOG.info("Trust roots bundle changed, reloading it.")
+                    self._load()
+            return self.roots
+
+    def _bundle_path(self):
+        """
+        Get the path of the trust roots bundle.
+
+        :return str: The configured path or the path of the operating system's
+            trust roots.
+        """
+        return self.path or trust_list.get_path()
+
+    def _load(self):
+        """
+        Load and parse the trust roots bundle.
+
+        .. Note:: Must be called while holding :attr:`_lock`.
+        """
+        path = self._bundle_path()
+        self._reload = False
+        self._last_check = time.time()
+        self._mtime = os.path.getmtime(path)
+        with open(path, 'rb') as f_obj:
+            data = f_obj.read()
+        self.roots = tuple(
+            asn1crypto.x509.Certificate.load(der_bytes)
+            for type_name, _, der_bytes in asn1crypto.pem.unarmor(
+                data, multiple=True)
+            if type_name == 'CERTIFICATE'
+        )
+        self.generation += 1
+        LOG.info("Loaded %d trust roots from %s.", len(self.roots), path)
+
+    def validation_context(self, ocsps=None):
+        """
+        Make a validation context with the shared trust roots.
+
+        :param list ocsps: Binary OCSP responses to validate with, fetching
+            revocation information is not allowed if these are passed.
+        :return certvalidator.ValidationContext: A new validation context.
+        """
+        roots = self.get_roots()
+        if ocsps is None:
+            return certvalidator.ValidationContext(trust_roots=roots)
+        return certvalidator.ValidationContext(
+            trust_roots=roots,
+            ocsps=ocsps,
+            allow_fetching=False
+        )
+
+
+#: The trust store that is shared within the process.
+TRUST_STORE = TrustStore()
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 """
 This is a general purpose scheduler. It does best effort scheduling and
-execution of expired items in the order they are added. This also means that
-there is no guarantee the tasks will be executed on time every time, in fact
-they will always be late, even if just by milliseconds. If you need it to be
-done on time, you schedule it early, but remember that it will still be best
-effort.
+execution of expired items in the order of their scheduled time. Tasks are
+kept in a min-heap so the scheduler thread can sleep exactly until the next
+task is due, it is woken up when a task is added that is due earlier. This
+also means that there is no guarantee the tasks will be executed on time every
+time, in fact they will always be late, even if just by milliseconds. If you
+need it to be done on time, you schedule it early, but remember that it will
+still be best effort.
 
 The way this scheduler is supposed to be used is to add a scheduling queue,
 then you can add tasks to the queue to either be put in a task queue ASAP, or
@@ -20,16 +22,38 @@ This module defines the following objects:
  - :class:`ocspd.scheduling.SchedulerThread`
     An object that is capable of scheduling and unscheduling tasks that you
     can define with :class:`ocspd.scheduling.ScheduledTaskContext`.
+ - :class:`ocspd.scheduling.PriorityTaskQueue`
+    A task queue that hands out the most urgent task first, it can be used
+    instead of a FIFO queue for a queue of the scheduler.
+ - :class:`ocspd.scheduling.FairTaskQueue`
+    A task queue that keeps tasks in groups and hands them out from each
+    group in turn, optionally limiting how many tasks of a group are being
+    processed at the same time.
+ - :class:`ocspd.scheduling.LoadSmoother`
+    An object that can be attached to a queue of the scheduler to spread
+    tasks that are scheduled for the same moment over a window before that
+    moment.
 """
 import threading
 import logging
+import bisect
 import datetime
-from queue import Queue
+import heapq
+import itertools
+import math
 import time
-from collections import defaultdict
+import zlib
+from queue import Queue, Empty, Full
+from collections import defaultdict, deque
 
 LOG = logging.getLogger(__name__)
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+#: Amount of seconds after which a due task is queued again, when its queue
+#: was full.
+FULL_QUEUE_RETRY = 1
+
 
 class ScheduledTaskContext(object):
     """
@@ -89,6 +113,395 @@ class ScheduledTaskContext(object):
             self.task_name, self.subject)
 
 
+class PriorityTaskQueue(Queue):
+    """
+    A task queue that hands out the task with the lowest priority first,
+    instead of the task that was added first. The priority of a task is
+    determined by a function when the task is added to the queue. Tasks with
+    the same priority are handed out in the order they were added.
+    """
+    def __init__(self, maxsize=0, priority=None):
+        """
+        Initialise the queue.
+
+        :param int maxsize: Maximum queue depth, [default=0 (unlimited)].
+        :param callable priority: Function that returns a sortable priority
+            for a context, lower priorities are handed out first
+            **(required)**.
+        """
+        assert priority is not None, \
+            "A priority queue needs a function to get a priority."
+        self.priority = priority
+        self._sequence = itertools.count()
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(
+            self.queue, (self.priority(item), next(self._sequence), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+
+class FairTaskQueue(object):
+    """
+    A task queue that keeps a sub-queue per group of tasks and hands out
+    tasks from the groups in turn (round-robin), so a group with a lot of
+    tasks can't delay the tasks of other groups. Within a group, tasks are
+    handed out in the order they were added, or by priority if a priority
+    function is passed.
+
+    The amount of tasks of one group that are handed out but not marked done
+    yet can be limited. A group that reached that limit is skipped until one
+    of its tasks is marked done with :meth:`task_done`.
+
+    This queue has the same interface as :class:`queue.Queue`, except that
+    :meth:`task_done` takes the task that is done.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, maxsize=0, group=None, priority=None, max_active=0):
+        """
+        Initialise the queue.
+
+        :param int maxsize: Maximum queue depth, [default=0 (unlimited)].
+        :param callable group: Function that returns a hashable group for a
+            context **(required)**.
+        :param callable priority: Function that returns a sortable priority
+            for a context, lower priorities are handed out first within a
+            group (optional).
+        :param int max_active: Maximum amount of tasks per group that are
+            handed out and not done yet, [default=0 (unlimited)].
+        """
+        assert group is not None, \
+            "A fair queue needs a function to get the group of a task."
+        self.maxsize = maxsize
+        self.group = group
+        self.priority = priority
+        self.max_active = max_active
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+        self.unfinished_tasks = 0
+        self._size = 0
+        self._sequence = itertools.count()
+        #: A heap of tasks per group.
+        self._groups = {}
+        #: The groups that have tasks, in the order they get their turn.
+        self._turns = deque()
+        #: Amount of handed out tasks per group that are not done yet.
+        self._active = defaultdict(int)
+        #: The group each handed out task was taken from.
+        self._active_tasks = {}
+
+    def qsize(self):
+        """
+        Return the amount of tasks in the queue.
+        """
+        with self.mutex:
+            return self._size
+
+    def empty(self):
+        """
+        Return True if the queue is empty.
+        """
+        with self.mutex:
+            return not self._size
+
+    def full(self):
+        """
+        Return True if the queue is full.
+        """
+        with self.mutex:
+            return 0 < self.maxsize <= self._size
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Put a task in the sub-queue of its group.
+
+        :param item: The task.
+        :param bool block: Wait for a free slot if the queue is full.
+        :param int|float timeout: Maximum time to wait for a free slot.
+        :raises queue.Full: If no free slot is available in time.
+        """
+        with self.not_full:
+            if self.maxsize > 0:
+                if not block:
+                    if self._size >= self.maxsize:
+                        raise Full
+                elif timeout is None:
+                    while self._size >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    endtime = time.time() + timeout
+                    while self._size >= self.maxsize:
+                        remaining = endtime - time.time()
+                        if remaining <= 0.0:
+                            raise Full
+                        self.not_full.wait(remaining)
+            group = self.group(item)
+            if group not in self._groups:
+                self._groups[group] = []
+                self._turns.append(group)
+            priority = self.priority(item) if self.priority else 0
+            heapq.heappush(
+                self._groups[group],
+                (priority, next(self._sequence), item)
+            )
+            self._size += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        """
+        Put a task in the queue without blocking.
+        """
+        return self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        """
+        Take a task from the next group that has tasks and did not reach its
+        limit of active tasks.
+
+        :param bool block: Wait until a task is available.
+        :param int|float timeout: Maximum time to wait for a task.
+        :raises queue.Empty: If no task is available in time.
+        """
+        with self.not_empty:
+            group = self._next_group()
+            if not block:
+                if group is None:
+                    raise Empty
+            elif timeout is None:
+                while group is None:
+                    self.not_empty.wait()
+                    group = self._next_group()
+            else:
+                endtime = time.time() + timeout
+                while group is None:
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+                    group = self._next_group()
+            tasks = self._groups[group]
+            item = heapq.heappop(tasks)[-1]
+            if tasks:
+                # Back in line for its next turn.
+                self._turns.append(group)
+            else:
+                del self._groups[group]
+            self._size -= 1
+            self._active[group] += 1
+            self._active_tasks[item] = group
+            self.not_full.notify()
+            return item
+
+    def get_nowait(self):
+        """
+        Take a task from the queue without blocking.
+        """
+        return self.get(block=False)
+
+    def _next_group(self):
+        """
+        Take the first group in line that did not reach its limit of active
+        tasks from the line. Groups that reached their limit keep their place.
+
+        .. Note:: Must be called while holding :attr:`mutex`.
+
+        :return: A group or None if no group can be served right now.
+        """
+        for index, group in enumerate(self._turns):
+            if not self.max_active or self._active[group] < self.max_active:
+                del self._turns[index]
+                return group
+        return None
+
+    def task_done(self, item=None):
+        """
+        Mark a task that was taken from the queue as done, this frees up a
+        slot for its group.
+
+        :param item: The task that is done, if this is not passed the group's
+            slot is not freed.
+        :raises ValueError: If called more times than there were tasks.
+        """
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - 1
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks = unfinished
+            if item is not None and item in self._active_tasks:
+                group = self._active_tasks.pop(item)
+                self._active[group] -= 1
+                if not self._active[group]:
+                    del self._active[group]
+                if group in self._groups:
+                    # The group may be waiting for a free slot.
+                    self.not_empty.notify()
+            if not unfinished:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        """
+        Wait until all tasks in the queue are done.
+        """
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+
+class LoadSmoother(object):
+    """
+    Spreads tasks that are scheduled for the same moment over a window before
+    that moment, so they don't all run at once.
+
+    The scheduled time of a task is treated as its deadline, the task is moved
+    to a moment within ``window`` seconds before the deadline. The moment is
+    picked with a deterministic offset based on a key of the task, so the same
+    task is planned at the same moment every time. If a ``rate`` is set, no
+    more than ``rate`` tasks per second are planned for the same bucket, tasks
+    are moved to the nearest moment in the window that still has room. A task
+    is never moved past its deadline, if the window is full the task is
+    planned at its preferred moment anyway.
+    """
+    def __init__(self, window, rate=0, key=None, bucket=None):
+        """
+        Initialise the load smoother.
+
+        :param int window: Amount of seconds before the deadline a task may be
+            moved to.
+        :param int|float rate: Maximum amount of tasks per second per bucket,
+            0 for unlimited (default=0).
+        :param callable key: Function that returns a string for a context,
+            used to calculate the offset of a task in the window. Defaults to
+            the representation of the context's subject.
+        :param callable bucket: Function that returns a hashable for a
+            context, the rate is enforced per bucket. Defaults to one bucket
+            for all tasks.
+        """
+        self.window = window
+        self.rate = rate
+        self.key = key or (lambda ctx: repr(ctx.subject))
+        self.bucket = bucket or (lambda ctx: None)
+        #: Length of a planning slot in seconds, a slot is at least a second
+        #: so a rate of less than 1 results in longer slots.
+        self._slot_length = max(1.0, 1.0 / rate) if rate else 1.0
+        #: Amount of tasks that fit in a slot.
+        self._slot_capacity = max(1, int(rate))
+        #: Amount of planned tasks per slot, per bucket.
+        self._slots = defaultdict(dict)
+        #: Sorted slots that are at capacity, per bucket, so a free slot is
+        #: found without checking every slot of a full window.
+        self._full = defaultdict(list)
+        #: The bucket and slot each planned context is planned in.
+        self._planned = {}
+
+    def smooth(self, ctx, deadline):
+        """
+        Plan a context and return the time it should be scheduled at.
+
+        :param ScheduledTaskContext ctx: The context to plan.
+        :param datetime.datetime deadline: The latest time the context should
+            be scheduled at.
+        :return datetime.datetime: The time to schedule the context at.
+        """
+        self.release(ctx)
+        length = self._slot_length
+        deadline_s = (deadline - _EPOCH).total_seconds()
+        now_s = (datetime.datetime.now() - _EPOCH).total_seconds()
+        first = int(math.ceil(max(deadline_s - self.window, now_s) / length))
+        last = int(math.floor(deadline_s / length))
+        if first >= last:
+            # No room to move the task, it's due (almost) now.
+            return deadline
+        # Deterministic offset in the window for this context.
+        fraction = zlib.crc32(self.key(ctx).encode('utf-8')) / 2.0 ** 32
+        slot = first + int(fraction * (last - first + 1))
+        if self.rate:
+            bucket = self.bucket(ctx)
+            slot = self._free_slot(self._full[bucket], slot, first, last)
+            slots = self._slots[bucket]
+            slots[slot] = slots.get(slot, 0) + 1
+            if slots[slot] == self._slot_capacity:
+                bisect.insort(self._full[bucket], slot)
+            self._planned[ctx] = (bucket, slot)
+        return _EPOCH + datetime.timedelta(seconds=slot * length)
+
+    @staticmethod
+    def _free_slot(full, preferred, first, last):
+        """
+        Find the slot nearest to the preferred slot that still has room. The
+        nearest free slots are just outside the run of consecutive full slots
+        around the preferred slot, the run is found with binary searches, so
+        this takes logarithmic time, also when the window is full.
+
+        :param list full: Sorted slots that are at capacity.
+        :param int preferred: The preferred slot.
+        :param int first: The first slot that can be used.
+        :param int last: The last slot that can be used.
+        :return int: The nearest free slot, or the preferred slot if none of
+            the slots have room.
+        """
+        index = bisect.bisect_left(full, preferred)
+        if index == len(full) or full[index] != preferred:
+            return preferred
+        # Slots full[low:index + 1] are consecutive if the difference of the
+        # slots equals the difference of their indexes.
+        low, high = 0, index
+        while low < high:
+            middle = (low + high) // 2
+            if preferred - full[middle] == index - middle:
+                high = middle
+            else:
+                low = middle + 1
+        before = full[low] - 1
+        low, high = index, len(full) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if full[middle] - preferred == middle - index:
+                low = middle
+            else:
+                high = middle - 1
+        after = full[low] + 1
+        candidates = [
+            slot for slot in (before, after) if first <= slot <= last]
+        if not candidates:
+            LOG.debug("No free slots left in the window, overbooking a slot.")
+            return preferred
+        return min(candidates, key=lambda slot: abs(slot - preferred))
+
+    def release(self, ctx):
+        """
+        Forget the slot a context was planned in, this is done when the
+        context is added to its task queue or when it is cancelled.
+
+        :param ScheduledTaskContext ctx: A previously planned context.
+        """
+        try:
+            bucket, slot = self._planned.pop(ctx)
+        except KeyError:
+            return
+        slots = self._slots[bucket]
+        slots[slot] -= 1
+        if slots[slot] == self._slot_capacity - 1:
+            full = self._full[bucket]
+            del full[bisect.bisect_left(full, slot)]
+            if not full:
+                del self._full[bucket]
+        if slots[slot] <= 0:
+            del slots[slot]
+            if not slots:
+                del self._slots[bucket]
+
+
 class SchedulerThread(threading.Thread):
     """
     This object can be used to schedule tasks for contexts.
@@ -104,6 +517,16 @@ class SchedulerThread(threading.Thread):
     tasks schedule times. If you want to run a task ASAP, you probably don't
     that, you should pass ``sched_time=None`` instead, it will bypass the
     scheduling mechanism and place your task directly into the worker queue.
+
+    Scheduled tasks are kept in a min-heap ordered by their scheduled time,
+    so finding the next task to run costs O(log n). The thread waits on a
+    condition variable until the first task is due, adding a task that is due
+    before the current first task wakes the thread up.
+
+    The indexes used for cancelling tasks are dicts and sets, so cancelling
+    or rescheduling a task takes constant time. The schedule and the indexes
+    are protected by one internal lock, tasks can be added and cancelled from
+    any thread.
     """
     def __init__(self, *args, **kwargs):
         """
@@ -111,45 +534,86 @@ class SchedulerThread(threading.Thread):
         :class:`threading.Thread`.
 
         :kwarg iterable queues: A list, tuple or any iterable that returns
-            strings that should be the names of queues.
-        :kwarg int|float sleep: The sleep time in seconds between checking the
-            expired items in the queue (default=1)
+            strings that should be the names of queues, or dicts with keyword
+            arguments for :meth:`add_queue`.
+        :kwarg int|float sleep: The maximum time in seconds to wait for the
+            next task before checking whether the thread should stop
+            (default=1)
         :raises KeyError: If the queue name is already taken (only when queues
             kwarg is used).
         """
         self.stop = False
         self._queues = {}
-
-        #: The schedule contains items indexed by time.
-        self.schedule = defaultdict(lambda: [])
-        #: Keeping the tasks in reverse order helps for faster unscheduling.
+        self._smoothers = {}
+
+        #: The schedule is a heap of ``[sched_time, sequence, context]``
+        #: entries, the sequence number keeps tasks with the same scheduled
+        #: time in the order they were added. Cancelled entries have their
+        #: context set to ``None`` and are discarded when they surface.
+        self.schedule = []
+        #: Amount of cancelled entries that are still in the heap.
+        self._cancelled = 0
+        self._sequence = itertools.count()
+        #: Protects the schedule and all indexes below, it is also used to
+        #: wake up the scheduler thread when a task is added that should run
+        #: earlier than the first task. The underlying lock is re-entrant.
+        self._condition = threading.Condition()
+        #: Keeping the heap entries by context allows for fast unscheduling.
         self.scheduled_by_context = {}
         #: Keeping the tasks per queue name helps faster queue deletion.
         self.scheduled_by_queue = {}
-        #: To allow removing by subject we keep the scheduled tasks by subject.
-        self.scheduled_by_subject = defaultdict(lambda: [])
+        #: To allow removing by subject we keep the scheduled tasks by subject,
+        #: subjects without scheduled tasks are removed from this dict.
+        self.scheduled_by_subject = {}
 
         queues = kwargs.pop('queues', None)
         if queues:
             for queue_ in queues:
-                self.add_queue(queue_)
+                if isinstance(queue_, dict):
+                    self.add_queue(**queue_)
+                else:
+                    self.add_queue(queue_)
 
         self.sleep = kwargs.pop('sleep', 1)
 
         super(SchedulerThread, self).__init__(*args, **kwargs)
 
-    def add_queue(self, name, max_size=0):
+    def add_queue(self, name, max_size=0, smoother=None, priority=None,
+                  group=None, max_active=0):
+        # pylint: disable=too-many-arguments
         """
         Add a scheduled queue to the scheduler.
 
         :param str name: A unique name for the queue.
         :param int max_size: Maximum queue depth, [default=0 (unlimited)].
+        :param LoadSmoother smoother: Spread tasks that are added with
+            ``smooth=True`` over a window before their scheduled time
+            (optional).
+        :param callable priority: Make the queue a
+            :class:`PriorityTaskQueue` that orders tasks by the result of
+            this function instead of a FIFO queue (optional).
+        :param callable group: Make the queue a :class:`FairTaskQueue` that
+            hands out tasks of the groups returned by this function in turn,
+            within a group ordered by ``priority`` if it is passed
+            (optional).
+        :param int max_active: Maximum amount of tasks per group that are
+            being worked on at the same time, only for queues with a
+            ``group`` function, [default=0 (unlimited)].
         :raises KeyError: If the queue name is already taken.
         """
-        if name in self._queues:
-            raise KeyError("A queue with name %s already exists.", name)
-        self._queues[name] = Queue(max_size)
-        self.scheduled_by_queue[name] = []
+        with self._condition:
+            if name in self._queues:
+                raise KeyError("A queue with name %s already exists.", name)
+            if group is not None:
+                self._queues[name] = FairTaskQueue(
+                    max_size, group, priority, max_active)
+            elif priority is not None:
+                self._queues[name] = PriorityTaskQueue(max_size, priority)
+            else:
+                self._queues[name] = Queue(max_size)
+            self.scheduled_by_queue[name] = set()
+            if smoother is not None:
+                self._smoothers[name] = smoother
 
     def remove_queue(self, name):
         """
@@ -158,17 +622,17 @@ class SchedulerThread(threading.Thread):
         :param str name: The name of the existing queue.
         :raises KeyError: If the queue doesn't exist.
         """
-        try:
-            for ctx in self.scheduled_by_queue[name]:
-                sched_time = self.scheduled_by_context.pop(ctx)
-                self.schedule[sched_time].remove(ctx)
-                del self.scheduled_by_subject[ctx.subject]
-            del self.scheduled_by_queue[name]
-            del self._queues[name]
-        except KeyError:
-            raise KeyError("A queue with name %s doesn't exist.", name)
-
-    def add_task(self, ctx):
+        with self._condition:
+            try:
+                for ctx in self.scheduled_by_queue.pop(name):
+                    self._discard_entry(self.scheduled_by_context.pop(ctx))
+                    self._unindex_subject(ctx)
+                del self._queues[name]
+                self._smoothers.pop(name, None)
+            except KeyError:
+                raise KeyError("A queue with name %s doesn't exist.", name)
+
+    def add_task(self, ctx, smooth=False, block=True, timeout=None):
         """
         Add a :class:`~scheduler.ScheduledTaskContext` to be added to the task
         queue either ASAP, or at a specific time.
@@ -178,7 +642,15 @@ class SchedulerThread(threading.Thread):
 
         :param ScheduledTaskContext ctx: A context containing data for a
             worker thread.
-        :raises queue.Queue.Full: If the underlying task queue is full.
+        :param bool smooth: Treat the scheduled time as a deadline and let
+            the queue's :class:`LoadSmoother`, if it has one, pick the actual
+            scheduled time (default=False).
+        :param bool block: When adding a task ASAP, wait for room in the task
+            queue if it is full (default=True).
+        :param int|float timeout: Maximum amount of seconds to wait for room
+            in the task queue, None to wait as long as it takes.
+        :raises queue.Queue.Full: If the underlying task queue is full and
+            ``block`` is False or there was no room within ``timeout``.
         :raises TypeError: If the passed context is not a
             :class:`~scheduler.ScheduledTaskContext`
         :raises KeyError: If the task queue doesn't exist.
@@ -193,7 +665,7 @@ class SchedulerThread(threading.Thread):
         ctx.scheduler = self
         if not ctx.sched_time:
             # Run scheduled tasks ASAP by adding it to the queue.
-            self._queues[ctx.task_name].put(ctx)
+            self._queues[ctx.task_name].put(ctx, block, timeout)
             return
 
         if isinstance(ctx.sched_time, int):
@@ -201,18 +673,39 @@ class SchedulerThread(threading.Thread):
             ctx.sched_time = datetime.datetime.now() + \
                 datetime.timedelta(seconds=ctx.sched_time)
 
-        if ctx in self.scheduled_by_context:
-            LOG.warning("Task %s was already scheduled, unscheduling.", ctx)
-            self.cancel_task(ctx)
-        # Run scheduled tasks after ctx.sched_time seconds.
-        self.scheduled_by_context[ctx] = ctx.sched_time
-        self.scheduled_by_queue[ctx.task_name].append(ctx)
-        self.schedule[ctx.sched_time].append(ctx)
-        self.scheduled_by_subject[ctx.subject].append(ctx)
+        with self._condition:
+            if ctx in self.scheduled_by_context:
+                LOG.warning(
+                    "Task %s was already scheduled, unscheduling.", ctx)
+                self.cancel_task(ctx)
+            smoother = self._smoothers.get(ctx.task_name)
+            if smooth and smoother is not None:
+                ctx.sched_time = smoother.smooth(ctx, ctx.sched_time)
+            self._push(ctx)
         LOG.info(
             "Scheduled %s at %s",
             ctx, ctx.sched_time.strftime('%Y-%m-%d %H:%M:%S'))
 
+    def _push(self, ctx):
+        """
+        Add a task to the schedule and the indexes.
+
+        .. Note:: Must be called while holding :attr:`_condition`.
+
+        :param ScheduledTaskContext ctx: The task, with an absolute
+            ``sched_time``.
+        """
+        # Run scheduled tasks after ctx.sched_time seconds.
+        entry = [ctx.sched_time, next(self._sequence), ctx]
+        self.scheduled_by_context[ctx] = entry
+        self.scheduled_by_queue[ctx.task_name].add(ctx)
+        self.scheduled_by_subject.setdefault(ctx.subject, set()).add(ctx)
+        heapq.heappush(self.schedule, entry)
+        if self.schedule[0] is entry:
+            # This task is due before anything else, the thread may be
+            # waiting for a later task so wake it up.
+            self._condition.notify()
+
     def cancel_task(self, ctx):
         """
         Remove a task from the scheduler.
@@ -224,19 +717,75 @@ class SchedulerThread(threading.Thread):
             worker thread.
         :return bool: True for successfully cancelled task or False.
         """
-        try:
-            # Find out when it was scheduled
-            sched_time = self.scheduled_by_context.pop(ctx)
-            # There can be more than one task scheduled in the same time
-            # slot so we need to filter out any value that is not our target
-            # and leave it
-            self.schedule[sched_time].remove(ctx)
-            self.scheduled_by_queue[ctx.task_name].remove(ctx)
-            self.scheduled_by_subject[ctx.subject].remove(ctx)
+        with self._condition:
+            try:
+                # Find the heap entry of the task and mark it as cancelled,
+                # it is discarded when it reaches the top of the heap.
+                entry = self.scheduled_by_context.pop(ctx)
+            except KeyError:
+                LOG.warning("Can't unschedule, %s wasn't scheduled.", ctx)
+                return False
+            self._discard_entry(entry)
+            self._unindex(ctx)
             return True
-        except KeyError:
-            LOG.warning("Can't unschedule, %s wasn't scheduled.", ctx)
-            return False
+
+    def _release(self, ctx):
+        """
+        Release the planned slot of a context in its queue's smoother.
+
+        .. Note:: Must be called while holding :attr:`_condition`.
+
+        :param ScheduledTaskContext ctx: A context that is no longer
+            scheduled.
+        """
+        smoother = self._smoothers.get(ctx.task_name)
+        if smoother is not None:
+            smoother.release(ctx)
+
+    def _unindex(self, ctx):
+        """
+        Remove a context from the queue and subject indexes, this is a
+        constant time operation.
+
+        .. Note:: Must be called while holding :attr:`_condition`.
+
+        :param ScheduledTaskContext ctx: A context that was just removed
+            from :attr:`scheduled_by_context`.
+        """
+        self.scheduled_by_queue[ctx.task_name].discard(ctx)
+        self._unindex_subject(ctx)
+        self._release(ctx)
+
+    def _unindex_subject(self, ctx):
+        """
+        Remove a context from the subject index, and forget about the subject
+        when it has no scheduled tasks left.
+
+        .. Note:: Must be called while holding :attr:`_condition`.
+
+        :param ScheduledTaskContext ctx: A context that was just removed
+            from :attr:`scheduled_by_context`.
+        """
+        ctxs = self.scheduled_by_subject.get(ctx.subject)
+        if ctxs is not None:
+            ctxs.discard(ctx)
+            if not ctxs:
+                del self.scheduled_by_subject[ctx.subject]
+
+    def _discard_entry(self, entry):
+        """
+        Mark a heap entry as cancelled. When more than half of the heap
+        consists of cancelled entries, the heap is rebuilt without them so it
+        doesn't keep growing when tasks are rescheduled a lot.
+
+        :param list entry: A ``[sched_time, sequence, context]`` heap entry.
+        """
+        entry[-1] = None
+        self._cancelled += 1
+        if self._cancelled * 2 > len(self.schedule):
+            self.schedule = [x for x in self.schedule if x[-1] is not None]
+            heapq.heapify(self.schedule)
+            self._cancelled = 0
 
     def get_task(self, task_name, blocking=True, timeout=None):
         """
@@ -254,17 +803,23 @@ class SchedulerThread(threading.Thread):
             raise KeyError("Queue with task name {} doesn't exist.", task_name)
         return self._queues[task_name].get(blocking, timeout)
 
-    def task_done(self, task_name):
+    def task_done(self, task_name, ctx=None):
         """
         Mark a task done on a queue, this up the queue's counter of completed
         tasks.
 
         :param str task_name: The task queue name.
+        :param ScheduledTaskContext ctx: The context that is done, queues
+            that limit the amount of active tasks per group need it to free up
+            a slot for the group (optional).
         :raises KeyError: If the task queue does not exist.
         """
         if task_name not in self._queues:
             raise KeyError("Queue with task name {} doesn't exist.", task_name)
-        return self._queues[task_name].task_done()
+        queue_ = self._queues[task_name]
+        if ctx is not None and isinstance(queue_, FairTaskQueue):
+            return queue_.task_done(ctx)
+        return queue_.task_done()
 
     def run(self):
         """
@@ -273,9 +828,30 @@ class SchedulerThread(threading.Thread):
         LOG.info("Started a scheduler thread.")
         while not self.stop:
             self._run()
-            time.sleep(self.sleep)
+            with self._condition:
+                timeout = self._next_timeout()
+                if timeout > 0:
+                    self._condition.wait(timeout)
         LOG.debug("Goodbye cruel world..")
 
+    def _next_timeout(self):
+        """
+        Calculate how long the thread can wait before the first task in the
+        schedule is due. Never waits longer than :attr:`sleep` so a stop
+        request is honoured in time.
+
+        .. Note:: Must be called while holding :attr:`_condition`.
+
+        :return float: Amount of seconds to wait.
+        """
+        while self.schedule and self.schedule[0][-1] is None:
+            heapq.heappop(self.schedule)
+            self._cancelled -= 1
+        if not self.schedule:
+            return self.sleep
+        due_in = self.schedule[0][0] - datetime.datetime.now()
+        return min(due_in.total_seconds(), self.sleep)
+
     def run_all(self):
         """
         Run all tasks currently queued regardless schedule time.
@@ -287,21 +863,36 @@ class SchedulerThread(threading.Thread):
         Runs all scheduled tasks that have a scheduled time < now.
         """
         now = datetime.datetime.now()
-        # Take a copy of all sched_time keys
-        if all_tasks:
-            todo = list(self.schedule)
-        else:
-            # Only scheduled before or at now, default
-            todo = [x for x in self.schedule if x <= now]
-        for sched_time in todo:
-            items = self.schedule.pop(sched_time)
-            for ctx in items:
-                LOG.info("Adding %s to the %s queue.", ctx, ctx.task_name)
-                # Remove from reverse indexed dict
+        # Queue while holding the lock, so a task can't be cancelled between
+        # leaving the schedule and entering its queue. Never wait for a full
+        # queue, so a full queue can't block scheduling.
+        full = set()
+        deferred = []
+        with self._condition:
+            while self.schedule:
+                sched_time, _, ctx = self.schedule[0]
+                if ctx is None:
+                    # Cancelled task, just drop it
+                    heapq.heappop(self.schedule)
+                    self._cancelled -= 1
+                    continue
+                # Only scheduled before or at now, unless all tasks are wanted
+                if not all_tasks and sched_time > now:
+                    break
+                heapq.heappop(self.schedule)
+                # Remove from reverse indexed dicts
                 del self.scheduled_by_context[ctx]
-                self.scheduled_by_queue[ctx.task_name].remove(ctx)
-                self.scheduled_by_subject[ctx.subject].remove(ctx)
-                self._queues[ctx.task_name].put(ctx)
+                self._unindex(ctx)
+                if ctx.task_name in full:
+                    deferred.append(ctx)
+                    continue
+                try:
+                    self._queues[ctx.task_name].put_nowait(ctx)
+                except Full:
+                    full.add(ctx.task_name)
+                    deferred.append(ctx)
+                    continue
+                LOG.info("Added %s to the %s queue.", ctx, ctx.task_name)
                 late = datetime.datetime.now() - sched_time
                 if late.seconds < 1:
                     late = ''
@@ -313,6 +904,17 @@ class SchedulerThread(threading.Thread):
                     "Queued %s at %s%s",
                     ctx, now.strftime('%Y-%m-%d %H:%M:%S'), late)
 
+            if deferred:
+                # Try again when the workers had some time to make room.
+                LOG.debug(
+                    "Queue(s) %s full, retrying %d tasks in %d seconds.",
+                    ", ".join(sorted(full)), len(deferred), FULL_QUEUE_RETRY)
+                retry_time = datetime.datetime.now() + \
+                    datetime.timedelta(seconds=FULL_QUEUE_RETRY)
+                for ctx in deferred:
+                    ctx.sched_time = retry_time
+                    self._push(ctx)
+
     def cancel_by_subject(self, subject):
         """
         Cancel scheduled tasks by the task's context's subject.
@@ -323,6 +925,8 @@ class SchedulerThread(threading.Thread):
         :param obj subject: The object you want all scheduled tasks cancelled
             for.
         """
-        ctxs = self.scheduled_by_subject[subject]
-        for ctx in ctxs:
-            self.cancel_task(ctx)
+        with self._condition:
+            # Take a copy because cancelling changes the index
+            ctxs = list(self.scheduled_by_subject.get(subject, ()))
+            for ctx in ctxs:
+                self.cancel_task(ctx)
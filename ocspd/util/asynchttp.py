@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+A minimal HTTP/1.1 client built on :mod:`asyncio` streams, just enough to post
+OCSP requests from an event loop. Connections are kept alive and re-used per
+origin. Responses are returned as :class:`requests.Response` objects and errors
+are raised as :mod:`requests` exceptions, so code that handles responses and
+errors of the :mod:`requests` library can handle these too.
+
+.. Note:: Redirects are not followed, a redirect is raised as a
+    :exc:`requests.exceptions.HTTPError`.
+"""
+import asyncio
+import logging
+import ssl
+from collections import defaultdict
+import requests
+from requests.structures import CaseInsensitiveDict
+from future.standard_library import hooks
+with hooks():
+    from urllib.parse import urlparse
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncHTTPClient(object):
+    """
+    Posts data to HTTP(S) URLs from an event loop, keeping at most
+    ``max_idle`` idle connections per origin alive for re-use.
+    """
+    def __init__(self, max_idle=10):
+        """
+        Initialise the client.
+
+        :param int max_idle: Maximum amount of idle connections kept alive per
+            origin (default=10).
+        """
+        self.max_idle = max_idle
+        #: Idle ``(reader, writer)`` pairs per origin.
+        self._idle = defaultdict(list)
+        self._ssl_context = None
+
+    async def post(self, url, data=b'', headers=None, timeout=(10, 5)):
+        """
+        Post data to an URL.
+
+        :param str url: The URL to post to.
+        :param bytes data: The request body.
+        :param dict headers: Additional request headers.
+        :param tuple timeout: Connect and read timeouts in seconds.
+        :return requests.Response: The response.
+        :raises requests.exceptions.ConnectTimeout: Connecting took too long.
+        :raises requests.exceptions.ReadTimeout: The response took too long.
+        :raises requests.ConnectionError: The connection failed or the
+            response is malformed.
+        :raises requests.exceptions.HTTPError: A redirect was received.
+        """
+        parsed = urlparse(url)
+        https = parsed.scheme == 'https'
+        port = parsed.port or (443 if https else 80)
+        origin = (parsed.scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = "{}?{}".format(path, parsed.query)
+        request_headers = CaseInsensitiveDict({
+            'Host': parsed.hostname,
+            'Content-Length': str(len(data)),
+            'Connection': 'keep-alive',
+        })
+        request_headers.update(headers or {})
+        request = "POST {} HTTP/1.1\r\n{}\r\n\r\n".format(
+            path,
+            "\r\n".join(
+                "{}: {}".format(key, value)
+                for key, value in request_headers.items()
+            )
+        ).encode('latin-1') + data
+
+        connect_timeout, read_timeout = timeout
+        # A kept-alive connection may have been closed by the server, in that
+        # case try once more on a fresh connection.
+        while True:
+            reused = bool(self._idle[origin])
+            reader, writer = await self._connect(origin, connect_timeout)
+            try:
+                writer.write(request)
+                await asyncio.wait_for(writer.drain(), read_timeout)
+                status, reason, response_headers, body, keep_alive = \
+                    await asyncio.wait_for(self._read_response(reader),
+                                           read_timeout)
+                break
+            except asyncio.TimeoutError:
+                writer.close()
+                raise requests.exceptions.ReadTimeout(
+                    "Read timed out for {}".format(url))
+            except (asyncio.IncompleteReadError, ConnectionError) as exc:
+                writer.close()
+                if reused:
+                    LOG.debug("Kept-alive connection to %s was closed.", url)
+                    continue
+                raise requests.ConnectionError(
+                    "Connection to {} failed: {}".format(url, exc))
+            except (ValueError, asyncio.LimitOverrunError, OSError) as exc:
+                # Malformed response, too long lines or e.g. a TLS error.
+                writer.close()
+                raise requests.ConnectionError(
+                    "Bad response from {}: {}".format(url, exc))
+            except BaseException:
+                writer.close()
+                raise
+
+        if keep_alive and len(self._idle[origin]) < self.max_idle:
+            self._idle[origin].append((reader, writer))
+        else:
+            writer.close()
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.url = url
+        response.headers = response_headers
+        response._content = body  # pylint: disable=protected-access
+        if 300 <= status < 400:
+            raise requests.exceptions.HTTPError(
+                "Redirect {} {} for url: {}".format(status, reason, url),
+                response=response
+            )
+        return response
+
+    async def _connect(self, origin, connect_timeout):
+        """
+        Get an idle connection to the origin or open a new one.
+
+        :param tuple origin: Scheme, host name and port.
+        :param int|float connect_timeout: Connect timeout in seconds.
+        :return tuple: A :class:`asyncio.StreamReader` and
+            :class:`asyncio.StreamWriter` pair.
+        """
+        while self._idle[origin]:
+            reader, writer = self._idle[origin].pop()
+            if not reader.at_eof() and not writer.transport.is_closing():
+                return reader, writer
+            writer.close()
+        scheme, host, port = origin
+        ssl_context = None
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=ssl_context),
+                connect_timeout
+            )
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ConnectTimeout(
+                "Connecting to {}:{} timed out".format(host, port))
+        except OSError as exc:
+            raise requests.ConnectionError(
+                "Can't connect to {}:{}: {}".format(host, port, exc))
+
+    @staticmethod
+    async def _read_response(reader):
+        """
+        Read a HTTP response from a stream.
+
+        :param asyncio.StreamReader reader: The stream to read from.
+        :return tuple: Status code, reason, headers, body and whether the
+            connection can be kept alive.
+        """
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(status_line, None)
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) +
+            ['']
+        )[:3]
+        headers = CaseInsensitiveDict()
+        while True:
+            line = await reader.readline()
+            line = line.decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and \
+            headers.get('Connection', '').lower() != 'close'
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    # Skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'Content-Length' in headers:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return int(status), reason, headers, body, keep_alive
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
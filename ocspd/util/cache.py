@@ -3,9 +3,14 @@
 Defines a class that can be used as a decorator that will cache returns of a
 method for a set of arguments and/or keyword arguments. If the arguments are
 the same as the first time, it will take the result out of the cache.
+
+Also defines a thread-safe least recently used cache with expiring entries,
+that can be used to cache values explicitly.
 """
 import collections
 import functools
+import threading
+import time
 
 
 class cache(collections.OrderedDict):
@@ -41,3 +46,67 @@ class cache(collections.OrderedDict):
                 self[hashable] = func(*args, **kwargs)
             return self[hashable]
         return decorated
+
+
+class LRUCache(object):
+    """
+    A thread-safe least recently used cache with a maximum size. Entries
+    expire ``ttl`` seconds after they were added. The amount of cache hits and
+    misses is counted in :attr:`hits` and :attr:`misses`.
+    """
+    def __init__(self, max_size=10000, ttl=None):
+        """
+        Initialise the cache.
+
+        :param int max_size: Maximum amount of entries (default=10000).
+        :param int|float ttl: Amount of seconds after which entries expire,
+            None for never (default=None).
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get a value from the cache.
+
+        :param key: The key of the value.
+        :param default: Value to return if the key is not cached or expired.
+        :return: The cached value or ``default``.
+        """
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Add a value to the cache, if the cache is full the least recently used
+        value is removed.
+
+        :param key: The key of the value.
+        :param value: The value to cache.
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
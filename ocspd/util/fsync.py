@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Defines a class that syncs written files to disk, and collects the
+directories they were renamed in to sync those in batches, so a mass renewal
+of staples doesn't cause a directory ``fsync`` for every single file.
+
+Files are first written to a temporary file that is synced before it is
+renamed, so readers never see a partially written file, and after a crash or
+power failure the file contains either the old or the new data. Syncing the
+directories in batches only bounds how many renames may be lost.
+"""
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class SyncBatch(object):
+    """
+    Syncs written files before they are renamed, keeps track of the
+    directories they were renamed in, and syncs those all at once at most
+    every ``interval`` seconds.
+
+    The batch can be used from several threads.
+    """
+    def __init__(self, interval=0):
+        """
+        Initialise the batch.
+
+        :param int|float interval: Minimum amount of seconds between syncs, 0
+            to not sync at all (default=0).
+        """
+        self.interval = interval
+        self._directories = set()
+        self._last_sync = time.time()
+        self._lock = threading.Lock()
+
+    def sync_file(self, f_obj):
+        """
+        Sync a written temporary file to disk before it is renamed, unless
+        syncing is disabled.
+
+        :param file f_obj: The open file.
+        :raises OSError: If the file can't be synced.
+        """
+        if not self.interval:
+            return
+        f_obj.flush()
+        os.fsync(f_obj.fileno())
+
+    def add(self, filename):
+        """
+        Remember the directory of a file that was renamed, so it is synced
+        with the next batch.
+
+        :param str filename: Path of the file.
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            self._directories.add(os.path.dirname(filename))
+
+    def flush(self, force=False):
+        """
+        Sync the directories that files were renamed in since the last sync,
+        if the last sync was more than ``interval`` seconds ago.
+
+        :param bool force: Sync regardless of the time of the last sync.
+        """
+        now = time.time()
+        with self._lock:
+            if not self._directories or \
+                    (not force and now - self._last_sync < self.interval):
+                return
+            directories = self._directories
+            self._directories = set()
+            self._last_sync = now
+        for path in directories:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except (IOError, OSError) as exc:
+                LOG.warning("Can't sync %s to disk: %s", path, exc)
+        LOG.debug("Synced %d directories to disk.", len(directories))
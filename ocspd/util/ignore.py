@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Matches file paths against the glob patterns of the ``--ignore`` option.
+
+All patterns are compiled once into a single regular expression, so a path is
+matched against every pattern in one go. Patterns that are plain absolute
+directories, e.g. ``/etc/ssl/private/expired/``, are kept apart as literal
+prefixes, if a directory matches one of those all files in it are ignored
+without looking at them.
+"""
+import os
+import re
+
+
+def compile_pattern(pattern):
+    """
+    Translate a glob pattern to a regular expression.
+
+    :param str pattern: Glob pattern.
+    :return str: Regular expression that matches the whole path.
+    """
+    # Absolute or relative path
+    if not pattern.startswith(os.sep) or pattern.startswith("*"):
+        begin_regex = "^.*"  # relative
+    else:
+        begin_regex = "^{}".format(os.sep)  # absolute
+
+    if pattern.endswith(os.sep) or pattern.endswith("*"):
+        end_regex = ".*$"  # anything below this path matches
+    else:
+        end_regex = "$"  # only exactly this file name matches
+
+    pattern = pattern.lstrip("*{}".format(os.sep))
+    pattern = pattern.rstrip("*")
+
+    # Escape some characters
+    middle_regex = re.escape(pattern)
+    # Question marks replace any 1 character
+    middle_regex = middle_regex.replace(r"\?", ".")
+    # Double stars replace anything including "/" lazily
+    middle_regex = middle_regex.replace(r"\*\*", ".*?/?")
+    # Single star replaces anthing but "/"
+    middle_regex = middle_regex.replace(r"\*", "[^{}]*".format(os.sep))
+
+    return "{}{}{}".format(
+        begin_regex,
+        middle_regex,
+        end_regex
+    )
+
+
+class IgnoreMatcher(object):
+    """
+    Matches paths against a list of ignore patterns, case insensitively.
+    """
+    def __init__(self, patterns=None):
+        """
+        Compile the patterns.
+
+        :param list patterns: Glob patterns, see the ``--ignore`` option.
+        """
+        #: Lower case absolute directories, with trailing separator.
+        self.prefixes = set()
+        regexes = []
+        for pattern in patterns or []:
+            if pattern.startswith(os.sep) and pattern.endswith(os.sep) and \
+                    "*" not in pattern and "?" not in pattern:
+                self.prefixes.add(pattern.lower())
+            else:
+                regexes.append("(?:{})".format(compile_pattern(pattern)))
+        self.regex = None
+        if regexes:
+            self.regex = re.compile("|".join(regexes), re.IGNORECASE)
+
+    def _prefix_match(self, path):
+        """
+        Check if any of the literal directory prefixes matches a path.
+
+        :param str path: Path to a file or directory.
+        :return bool: True if the path is below an ignored directory.
+        """
+        if not self.prefixes:
+            return False
+        path = path.lower()
+        index = path.find(os.sep, 1)
+        while index != -1:
+            if path[:index + 1] in self.prefixes:
+                return True
+            index = path.find(os.sep, index + 1)
+        return False
+
+    def match(self, path):
+        """
+        Check if a path matches any of the patterns.
+
+        :param str path: Path to a file.
+        :return bool: True if the path should be ignored.
+        """
+        if self._prefix_match(path):
+            return True
+        return self.regex is not None and self.regex.match(path) is not None
+
+    def ignored(self, directory, names):
+        """
+        Match all files of a directory listing at once.
+
+        :param str directory: The directory the files are in.
+        :param iter names: File names in the directory.
+        :return set: The names that should be ignored.
+        """
+        names = list(names)
+        if self._prefix_match(os.path.join(directory, "")):
+            return set(names)
+        if self.regex is None:
+            return set()
+        return set(
+            name for name in names
+            if self.regex.match(os.path.join(directory, name))
+        )
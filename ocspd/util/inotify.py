@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+A minimal wrapper around the Linux inotify API using :mod:`ctypes`, so file
+system changes can be detected without polling and without depending on a
+third party library.
+
+Creating an :class:`ocspd.util.inotify.Inotify` object raises an
+:exc:`OSError` on systems that don't support inotify, callers can use that to
+fall back to polling.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+#: File was opened for writing and was closed.
+IN_CLOSE_WRITE = 0x00000008
+#: File was moved out of a watched directory.
+IN_MOVED_FROM = 0x00000040
+#: File was moved into a watched directory.
+IN_MOVED_TO = 0x00000080
+#: File was created in a watched directory.
+IN_CREATE = 0x00000100
+#: File was deleted from a watched directory.
+IN_DELETE = 0x00000200
+#: The watched directory itself was deleted.
+IN_DELETE_SELF = 0x00000400
+#: The event queue overflowed, events were lost.
+IN_Q_OVERFLOW = 0x00004000
+#: The watch was removed.
+IN_IGNORED = 0x00008000
+#: The subject of the event is a directory.
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+class Inotify(object):
+    """
+    An inotify instance with watches on directories. Events are returned as
+    ``(path, mask)`` tuples, where path is the path of the file the event is
+    about, or the watched directory itself if the event is not about a file in
+    it.
+    """
+    def __init__(self):
+        """
+        Initialise the inotify instance.
+
+        :raises OSError: If inotify is not available.
+        """
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            init = self._libc.inotify_init1
+        except AttributeError:
+            raise OSError("inotify is not supported on this system.")
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        #: Watched paths by watch descriptor.
+        self._paths = {}
+
+    def add_watch(self, path, mask):
+        """
+        Watch a directory for events.
+
+        :param str path: The directory to watch.
+        :param int mask: The events to watch for, e.g.
+            ``IN_CLOSE_WRITE | IN_DELETE``.
+        :raises OSError: If the directory can't be watched.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self._paths[wd] = path
+
+    @property
+    def watched(self):
+        """
+        The paths that are currently watched.
+
+        :return set: Paths.
+        """
+        return set(self._paths.values())
+
+    def read_events(self, timeout=None):
+        """
+        Wait for events and return them.
+
+        :param int|float timeout: Maximum amount of seconds to wait for
+            events, None to wait forever.
+        :return list: ``(path, mask)`` tuples, empty if no events arrived in
+            time.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            path = self._paths.get(wd)
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+            if name and path is not None:
+                path = os.path.join(path, os.fsdecode(name))
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        """
+        Close the inotify instance, this removes all watches.
+        """
+        os.close(self.fd)
+        self._paths.clear()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Defines a thread-safe pool of HTTP sessions, one per origin (scheme, host and
+port). Requests to the same OCSP server re-use kept-alive connections of the
+origin's session instead of setting up a new TCP (and TLS) connection for every
+request. Sessions that have not been used for a while are closed.
+"""
+import threading
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from future.standard_library import hooks
+with hooks():
+    from urllib.parse import urlparse
+
+LOG = logging.getLogger(__name__)
+
+
+class SessionPool(object):
+    """
+    Keeps a :class:`requests.Session` per origin. Every session keeps at most
+    ``max_connections`` idle connections to its origin alive. Sessions that
+    were not used for ``idle_timeout`` seconds are closed and removed from the
+    pool. The pool keeps some statistics per origin in :attr:`stats`.
+
+    The pool can be used instead of the :mod:`requests` module for posting
+    data, i.e.: ``pool.post(url, data=data)``.
+    """
+    def __init__(self, max_connections=10, idle_timeout=300):
+        """
+        Initialise the session pool.
+
+        :param int max_connections: Maximum amount of connections per origin
+            that are kept alive (default=10).
+        :param int|float idle_timeout: Amount of seconds after which an unused
+            session is closed (default=300).
+        """
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        #: Sessions and the time they were last used, by origin.
+        self._sessions = {}
+        #: Statistics per origin: the amount of ``requests``, ``errors``,
+        #: created ``sessions`` and ``evictions`` of idle sessions.
+        self.stats = {}
+
+    def post(self, url, **kwargs):
+        """
+        Post to an URL with the session of the URL's origin, takes the same
+        arguments as :func:`requests.post`.
+
+        :param str url: The URL to post to.
+        :return requests.Response: The response.
+        :raises requests.RequestException: When the request fails.
+        """
+        origin = self._origin(url)
+        session = self._session(origin)
+        try:
+            return session.post(url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.stats[origin]['errors'] += 1
+            raise
+
+    @staticmethod
+    def _origin(url):
+        """
+        Get the origin of an URL.
+
+        :param str url: An URL.
+        :return str: The URL's scheme, host and port, e.g.:
+            ``http://ocsp.example.com:80``.
+        """
+        parsed = urlparse(url)
+        port = parsed.port
+        if port is None:
+            port = 443 if parsed.scheme == 'https' else 80
+        return "{}://{}:{}".format(parsed.scheme, parsed.hostname, port)
+
+    def _session(self, origin):
+        """
+        Get the session for an origin, create one if there is none. Closes
+        sessions of other origins that have been idle for too long.
+
+        :param str origin: The origin to get a session for.
+        :return requests.Session: A session for the origin.
+        """
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            stats = self.stats.setdefault(origin, {
+                'requests': 0,
+                'errors': 0,
+                'sessions': 0,
+                'evictions': 0
+            })
+            try:
+                session = self._sessions[origin][0]
+            except KeyError:
+                LOG.debug("Creating a new HTTP session for %s", origin)
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.max_connections
+                )
+                # Adapters are matched by URL prefix, the session only serves
+                # this origin so the adapter is mounted on the whole scheme.
+                session.mount(
+                    "{}://".format(urlparse(origin).scheme), adapter)
+                stats['sessions'] += 1
+            self._sessions[origin] = (session, now)
+            stats['requests'] += 1
+        return session
+
+    def _evict_idle(self, now):
+        """
+        Close sessions that have not been used for ``idle_timeout`` seconds.
+
+        .. Note:: Must be called while holding :attr:`_lock`.
+
+        :param float now: The current time.
+        """
+        for origin, (session, last_used) in list(self._sessions.items()):
+            if now - last_used > self.idle_timeout:
+                LOG.debug("Closing idle HTTP session for %s", origin)
+                del self._sessions[origin]
+                self.stats[origin]['evictions'] += 1
+                session.close()
+
+    def close(self):
+        """
+        Close all sessions in the pool.
+        """
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
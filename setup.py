@@ -74,6 +74,7 @@ setup(
     url='https://code.greenhost.net/open/ocspd',
     packages=find_packages(),
     include_package_data=True,
+    python_requires='>=3.7',
     install_requires=install_requires,
     extras_require={
         'docs': docs_extras,
@@ -86,12 +87,10 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
         'Topic :: Internet :: Proxy Servers',
         'Topic :: Security',
         'Topic :: System :: Networking',